@@ -0,0 +1,145 @@
+"""
+Per-step UNet latency and peak memory on the 256x16 latent.
+
+    python benchmark_unet.py --attention sdpa chunked einsum
+    python benchmark_unet.py --batch_size 10 --device cpu --steps 3
+
+The UNet is built from the inference config with random weights, which does
+not change its speed. With classifier-free guidance every sampling step runs
+the UNet on twice the number of candidates, which is the default here.
+Outputs are compared with the einsum attention as a parity check.
+--compare_checkpoint also times the first backend with the forced
+CheckpointFunction wrapper the attention blocks used to go through while
+sampling, and --compile the first backend through torch.compile.
+"""
+
+import sys
+sys.path.append("src")
+
+import time
+import argparse
+from contextlib import contextmanager
+
+import torch
+import yaml
+
+from latent_diffusion.util import instantiate_from_config
+from latent_diffusion.modules.attention_backends import BACKENDS, set_attention_backend
+from latent_diffusion.modules.attention import BasicTransformerBlock
+from latent_diffusion.modules.diffusionmodules.openaimodel import AttentionBlock
+from latent_diffusion.modules.diffusionmodules.util import checkpoint
+from latent_diffusion.models.compiled_ddim import COMPILE_MODES, relative_error
+from utilities.runtime import CONFIG_PATH
+
+
+@contextmanager
+def legacy_checkpointing():
+    # the custom autograd checkpoint that used to wrap every attention block, even under no_grad
+    forwards = AttentionBlock.forward, BasicTransformerBlock.forward
+
+    def attention_block_forward(self, x):
+        return checkpoint(self._forward, (x,), self.parameters(), True)
+
+    def transformer_block_forward(self, x, context=None):
+        inputs = (x,) if context is None else (x, context)
+        return checkpoint(self._forward, inputs, self.parameters(), self.checkpoint)
+
+    AttentionBlock.forward, BasicTransformerBlock.forward = attention_block_forward, transformer_block_forward
+    try:
+        yield
+    finally:
+        AttentionBlock.forward, BasicTransformerBlock.forward = forwards
+
+
+def time_unet(unet, x, t, y, steps, device):
+    with torch.no_grad():
+        for _ in range(2):
+            unet(x, t, y=y)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+        start = time.time()
+        for _ in range(steps):
+            out = unet(x, t, y=y)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+    peak = torch.cuda.max_memory_allocated(device) / 1024**3 if device.type == "cuda" else None
+    return out, (time.time() - start) / steps, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--attention", type=str, nargs="+", default=BACKENDS, choices=BACKENDS, help="Attention backends to compare")
+    parser.add_argument("--chunk_memory_mb", type=int, default=256, help="Attention matrix cap of the chunked backend")
+    parser.add_argument("--batch_size", type=int, default=10, help="Candidates per sampling step")
+    parser.add_argument("--no_guidance", action="store_true", help="Do not double the batch for classifier-free guidance")
+    parser.add_argument("--compare_checkpoint", action="store_true", help="Also time the first backend with the legacy checkpoint wrapper around the attention blocks")
+    parser.add_argument("--compile", type=str, nargs="?", const="auto", default=None, choices=["auto"] + COMPILE_MODES, help="Also time the first backend through torch.compile (auto: CUDA graphs on CUDA)")
+    parser.add_argument("--steps", type=int, default=10, help="Timed UNet calls per configuration")
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    config = yaml.load(open(CONFIG_PATH, "r"), Loader=yaml.FullLoader)
+    params = config["model"]["params"]
+    unet = instantiate_from_config(params["unet_config"]).eval().to(device)
+
+    batch_size = args.batch_size if args.no_guidance else 2 * args.batch_size
+    torch.manual_seed(0)
+    x = torch.randn(batch_size, params["channels"], params["latent_t_size"], params["latent_f_size"], device=device)
+    t = torch.full((batch_size,), 500, device=device, dtype=torch.long)
+    y = torch.randn(batch_size, params["unet_config"]["params"]["extra_film_condition_dim"], device=device)
+    print(f"UNet input {list(x.shape)} on {device}")
+
+    reference = None
+    if "einsum" in args.attention:
+        set_attention_backend("einsum")
+        with torch.no_grad():
+            reference = unet(x, t, y=y)
+
+    for backend in args.attention:
+        if backend.startswith("sdpa_") and device.type != "cuda":
+            print(f"{backend:<16} skipped, kernel selection only applies to CUDA")
+            continue
+        set_attention_backend(backend, args.chunk_memory_mb)
+        try:
+            out, latency, peak = time_unet(unet, x, t, y, args.steps, device)
+        except RuntimeError as e:
+            # e.g. out of memory with the full attention matrix
+            print(f"{backend:<16} failed: {e}")
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+            continue
+        line = f"{backend:<16} {latency * 1000:9.1f} ms/step"
+        if peak is not None:
+            line += f"  peak {peak:6.2f} GB"
+        if reference is not None:
+            line += f"  max |out - einsum| {(out - reference).abs().max().item():.2e}"
+        print(line)
+
+    if args.compare_checkpoint:
+        set_attention_backend(args.attention[0], args.chunk_memory_mb)
+        _, direct, _ = time_unet(unet, x, t, y, args.steps, device)
+        with legacy_checkpointing():
+            _, legacy, _ = time_unet(unet, x, t, y, args.steps, device)
+        print(
+            f"attention blocks through CheckpointFunction {legacy * 1000:.1f} ms/step, "
+            f"direct call {direct * 1000:.1f} ms/step ({args.attention[0]} attention)"
+        )
+
+    if args.compile is not None:
+        set_attention_backend(args.attention[0], args.chunk_memory_mb)
+        mode = args.compile
+        if mode == "auto":
+            mode = "reduce-overhead" if device.type == "cuda" else "default"
+        eager_out, eager, _ = time_unet(unet, x, t, y, args.steps, device)
+        compiled_unet = torch.compile(unet, mode=mode, dynamic=False)
+        start = time.time()
+        with torch.no_grad():
+            compiled_unet(x, t, y=y)
+        print(f"torch.compile ({mode}) took {time.time() - start:.1f} s")
+        out, compiled, _ = time_unet(compiled_unet, x, t, y, args.steps, device)
+        print(
+            f"compiled {compiled * 1000:.1f} ms/step, eager {eager * 1000:.1f} ms/step "
+            f"({args.attention[0]} attention), max relative error {relative_error(out, eager_out):.2e}"
+        )
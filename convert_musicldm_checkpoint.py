@@ -0,0 +1,44 @@
+"""
+Convert the MusicLDM and CLAP checkpoints into a single inference bundle.
+
+    python convert_musicldm_checkpoint.py [--fp16]
+    python convert_musicldm_checkpoint.py --benchmark --device cuda:0
+
+The bundle holds the EMA UNet, VAE decoder (and encoder with --keep_encoder), vocoder, CLAP towers and the
+RoBERTa tokenizer files, so it can be copied to offline nodes on its own. It
+is loaded with --weights by infer_musicldm_continuous.py and
+musicldm_server.py, which then build the model without its training-only
+modules and without random initialization. --benchmark compares the startup
+time of both paths.
+"""
+
+import sys
+sys.path.append("src")
+
+import os
+import argparse
+
+import torch
+import yaml
+
+from latent_diffusion.models.inference import benchmark_startup, convert_checkpoint
+from utilities.runtime import CONFIG_PATH, prepare_checkpoints
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, default="lightning_logs/musicldm_checkpoints/musicldm-inference.safetensors", help="Bundle to write, .safetensors or a torch file (.pt)")
+    parser.add_argument("--fp16", action="store_true", help="Store the weights in half precision, they are cast back to float32 when loading")
+    parser.add_argument("--keep_encoder", action="store_true", help="Keep the VAE encoder in the bundle, needed to encode audio (e.g. audio-to-audio)")
+    parser.add_argument("--benchmark", action="store_true", help="Time the startup from the checkpoints against the startup from the weights file")
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu", help="Device used by --benchmark")
+    args = parser.parse_args()
+
+    prepare_checkpoints()
+    config = yaml.load(open(CONFIG_PATH, "r"), Loader=yaml.FullLoader)
+    if not os.path.exists(args.output):
+        convert_checkpoint(config, args.output, fp16=args.fp16, keep_encoder=args.keep_encoder)
+    else:
+        print(f"{args.output} already exists, not converting")
+    if args.benchmark:
+        benchmark_startup(config, args.output, args.device)
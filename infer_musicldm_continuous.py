@@ -17,6 +17,7 @@ import sys
 sys.path.append("src")
 
 import os
+import random
 import numpy as np
 import argparse
 import yaml
@@ -25,99 +26,170 @@ import time
 
 from pytorch_lightning.strategies.ddp import DDPStrategy
 from src.latent_diffusion.models.musicldm import MusicLDM, DDPM
-from src.utilities.data.dataset import TextDataset
-from torch.utils.data import DataLoader
+from latent_diffusion.models.pruning import CandidatePruner, parse_prune_schedule
+from latent_diffusion.models.inference import build_inference_model
+from latent_diffusion.models.compiled_ddim import COMPILE_MODES
+from latent_diffusion.modules.precision import PrecisionPolicy
+from latent_diffusion.modules.attention_backends import BACKENDS as ATTENTION_BACKENDS, get_attention_backend, set_attention_backend
 from pytorch_lightning import seed_everything
-from src.utilities.chkpt import ensure_checkpoints
+from utilities.pipeline import PipelineExecutor
+from utilities.runtime import CONFIG_PATH, close_combined_track, open_combined_track, prepare_checkpoints, read_prompts
+
+# Rough peak memory of one candidate of the default 256x16 latent in fp32 (CFG-doubled UNet pass,
+# VAE decode, vocoder and CLAP scoring of a 10 s segment). Only used where it cannot be measured.
+MEMORY_PER_CANDIDATE_GB = 0.75
+MEMORY_PER_CANDIDATE_LATENT_SIZE = 256 * 16
+
+
+def measure_memory_per_candidate(latent_diffusion, texts, guidance=True):
+    """Peak memory of one candidate through a segment, in GB.
+
+    On CUDA one probe composition of len(texts) candidates runs one UNet call
+    (doubled for classifier-free guidance), the VAE decode, the vocoder and
+    CLAP scoring under the current precision policy and attention backend, and
+    the allocator peak above the memory already in use is divided by the
+    number of candidates. Elsewhere MEMORY_PER_CANDIDATE_GB is scaled by the
+    latent size.
+    """
+    device = latent_diffusion.device
+    shape = latent_diffusion.get_latent_shape(len(texts))
+    if device.type != "cuda":
+        return MEMORY_PER_CANDIDATE_GB * shape[2] * shape[3] / MEMORY_PER_CANDIDATE_LATENT_SIZE
+
+    # the probe must not change the generated audio
+    rng_state = get_rng_state()
+    torch.cuda.synchronize(device)
+    baseline = torch.cuda.memory_allocated(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    with torch.no_grad():
+        z = torch.randn(shape, device=device)
+        c = latent_diffusion.get_learned_conditioning(texts)
+        z_in, c_in = (torch.cat([z, z]), torch.cat([c, c])) if guidance else (z, c)
+        t = torch.full((z_in.shape[0],), latent_diffusion.num_timesteps - 1, device=device, dtype=torch.long)
+        latent_diffusion.apply_model(z_in, t, c_in)
+        del z_in, c_in
+        mel = latent_diffusion.decode_first_stage(z)
+        waveform = latent_diffusion.mel_spectrogram_to_waveform(mel, save=False)
+        del mel
+        latent_diffusion.cond_stage_model.cos_similarity(torch.FloatTensor(waveform).squeeze(1), texts)
+    torch.cuda.synchronize(device)
+    peak = (torch.cuda.max_memory_allocated(device) - baseline) / 1024**3
+    set_rng_state(rng_state)
+    print(f"Measured {peak / len(texts):.3f} GB per candidate ({len(texts)} candidate probe, latent {list(shape[1:])})")
+    return peak / len(texts)
+
+
+def get_compositions_per_batch(n_gen, batch_memory_gb=None, memory_per_candidate_gb=MEMORY_PER_CANDIDATE_GB):
+    # Without a memory budget keep the original behaviour of one composition per sample_log call
+    if batch_memory_gb is None:
+        return 1
+    return max(1, int(batch_memory_gb // (memory_per_candidate_gb * n_gen)))
+
+
+def write_meta(logfile, fnames, texts):
+    with open(logfile, 'a') as f:
+        for fname, text in zip(fnames, texts):
+            f.write(f"{fname}: {text}\n")
+
+
+RESUME_STATE = "resume_state.pt"
+
+
+def get_rng_state():
+    state = {
+        "random": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["random"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def save_resume_state(log_path, state):
+    # write next to the target and rename, so a crash never leaves a half-written checkpoint
+    path = os.path.join(log_path, RESUME_STATE)
+    torch.save(state, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def save_checkpoint(log_path, checkpoint):
+    state = dict(checkpoint)
+    state["z_prev"] = {j: z.cpu() for j, z in checkpoint["z_prev"].items()}
+    state["combined"] = {j: stream.state_dict() for j, stream in checkpoint["combined"].items()}
+    save_resume_state(log_path, state)
+
+
+def load_resume_state(log_path):
+    path = os.path.join(log_path, RESUME_STATE)
+    if not os.path.exists(path):
+        raise ValueError(f"No resumable state found in {log_path}")
+    return torch.load(path, map_location="cpu")
+
+
+def main(config, compositions, seed, device="cuda:0", cpu_threads=None, batch_memory_gb=None, memory_per_candidate_gb=None, guidance_interval=None, sampler="ddim", steps=None, dpm_solver_order=2, clap_fp16=False, resume=None, audio_format="wav", latent_stitching=False, stitching_context=32, check_stitching=False, stitching_mel_tolerance=0.5, stitching_min_snr_db=15.0, pipelined=True, prune_schedule=None, weights=None, precision="fp32", attention_backend=None, attention_chunk_mb=None, compile_sampling=None, deep_cache_interval=None, deep_cache_depth=3):
+    device = torch.device(device)
+    if device.type == "cpu" and cpu_threads is not None:
+        torch.set_num_threads(cpu_threads)
+        print(f"Using {torch.get_num_threads()} CPU threads")
 
-# this will download the checkpoints if they are not already present
-ensure_checkpoints()
-
-# Path to your local inference config
-CONFIG_PATH = 'config/musicldm_inference.yaml'
-
-
-
-# 🧠 Monkey-patch torch.load to allow loading older .pt/.ckpt files
-# This is a workaround for the issue where torch.load() does not accept the 'weights_only' argument in older versions of PyTorch.
-# Allow problematic NumPy globals for legacy checkpoints
-
-from packaging import version
-
-
-# Only apply monkey-patches if PyTorch >= 2.0
-if version.parse(torch.__version__) >= version.parse("2.0"):
-    print(f"🛠 Applying patches for PyTorch {torch.__version__}...")
-
-    from torch.serialization import add_safe_globals
-    
-    # Patch 1: Allow old NumPy scalar used in checkpoint
-    add_safe_globals([np.core.multiarray.scalar])
-
-    # Patch 2: Monkey-patch torch.load to default to weights_only=False
-    original_load = torch.load
-    def patched_load(*args, **kwargs):
-        if 'weights_only' not in kwargs:
-            kwargs['weights_only'] = False
-        return original_load(*args, **kwargs)
-    torch.load = patched_load
-
-    # Patch 3: Monkey-patch load_state_dict to handle bad CLAP keys
-    original_load_state_dict = torch.nn.Module.load_state_dict
-
-    def safe_load_state_dict(self, state_dict, *args, **kwargs):
-        known_bad_keys = ["text_branch.embeddings.position_ids"]
-        removed_keys = []
-
-        if isinstance(state_dict, dict):
-            for key in known_bad_keys:
-                if key in state_dict:
-                    state_dict.pop(key)
-                    removed_keys.append(key)
-
-        if 'strict' not in kwargs and removed_keys:
-            kwargs['strict'] = False
-
-        if removed_keys:
-            print(f"🐒 Monkey-patch: removed {removed_keys} from checkpoint and set strict={kwargs['strict']}")
-
-        return original_load_state_dict(self, state_dict, *args, **kwargs)
-
-    torch.nn.Module.load_state_dict = safe_load_state_dict
-
-    print("✅ Monkey patches applied successfully.")
-else:
-    print(f"⚠️ PyTorch version {torch.__version__} is below 2.0 — no patching necessary.")
-
-
-def main(config, texts, seed):
     seed_everything(seed)
-    batch_size = config["model"]["params"]["batchsize"]
+    if attention_backend is not None:
+        set_attention_backend(attention_backend, attention_chunk_mb)
 
     log_path ="lightning_logs/musicldm_inference_logs"
     os.makedirs(log_path, exist_ok=True)
 
-    log_id = 0
-    while str(log_id) in os.listdir(log_path):
-        log_id += 1
-    log_path = os.path.join(log_path, str(log_id))
-    os.makedirs(log_path, exist_ok=True)
+    resume_state = None
+    if resume is None:
+        log_id = 0
+        while str(log_id) in os.listdir(log_path):
+            log_id += 1
+        log_path = os.path.join(log_path, str(log_id))
+        os.makedirs(log_path, exist_ok=True)
+    else:
+        log_path = os.path.join(log_path, str(resume))
+        resume_state = load_resume_state(log_path)
 
     print(f'Samples will be saved at: {log_path}')
 
-    dataset = TextDataset(data=texts, logfile=os.path.join(log_path, "meta.txt"))
-    loader = DataLoader(dataset, batch_size=1, shuffle=False, num_workers=config['model']['num_workers'])
-
-    latent_diffusion = MusicLDM(**config["model"]["params"])
+    if weights is None:
+        latent_diffusion = MusicLDM(**config["model"]["params"])
+        latent_diffusion.bake_ema()
+        latent_diffusion.to(device).eval()
+    else:
+        latent_diffusion = build_inference_model(config, weights, device)
     latent_diffusion.set_log_dir(log_path, log_path, log_path)
-    latent_diffusion.to("cuda:0")
 
-    ddim_steps = latent_diffusion.evaluation_params["ddim_sampling_steps"]
+    ddim_steps = steps if steps is not None else latent_diffusion.evaluation_params["ddim_sampling_steps"]
     ddim_eta = 1.0
     n_gen = latent_diffusion.evaluation_params["n_candidates_per_samples"]
     unconditional_guidance_scale = latent_diffusion.evaluation_params["unconditional_guidance_scale"]
     use_ddim = ddim_steps is not None
-    use_plms = False
+    use_plms = sampler == "plms"
+    use_dpm_solver = sampler == "dpm_solver"
+    if prune_schedule and sampler != "ddim":
+        raise ValueError("Candidate pruning is only supported with the ddim sampler")
+    if compile_sampling and sampler != "ddim":
+        raise ValueError("Compiled sampling is only supported with the ddim sampler")
+    if deep_cache_interval and sampler != "ddim":
+        raise ValueError("The deep feature cache is only supported with the ddim sampler")
+    if guidance_interval is not None and sampler != "ddim":
+        raise ValueError("The guidance interval is only supported with the ddim sampler")
+    precision_policy = PrecisionPolicy.parse(precision)
+    if clap_fp16 and device.type == "cuda":
+        # shorthand for clap=fp16 in the precision policy
+        if precision_policy.precisions["clap"] not in ("fp32", "fp16"):
+            raise ValueError("--clap_fp16 conflicts with clap=%s in --precision" % precision_policy.precisions["clap"])
+        precision_policy.precisions["clap"] = "fp16"
     x_T = None
     name = "waveform"
 
@@ -125,89 +197,272 @@ def main(config, texts, seed):
         if latent_diffusion.cond_stage_key_orig == "waveform":
             latent_diffusion.cond_stage_key = "text"
             latent_diffusion.cond_stage_model.embed_mode = "text"
-
-    for batch_idx, batch in enumerate(loader):
-        batch = {k: v.to("cuda:0") if isinstance(v, torch.Tensor) else v for k, v in batch.items()}
-        batch["text"] = ["experimental music is playing " + batch["text"][0]]
-
-        waveform_save_path = os.path.join(latent_diffusion.get_log_dir(), name)
-        os.makedirs(waveform_save_path, exist_ok=True)
-
-        with latent_diffusion.ema_scope("Generating"):
-            z, c = latent_diffusion.get_input(
-                batch,
-                latent_diffusion.first_stage_key,
-                return_first_stage_outputs=False,
-                force_c_encode=True,
-                return_original_cond=False
-            )
-            text = DDPM.get_input(latent_diffusion, batch, "text")
-            c = torch.cat([c] * n_gen, dim=0)
-            text = text * n_gen
-            batch_size = z.shape[0] * n_gen
-
-            unconditional_conditioning = None
-            if unconditional_guidance_scale != 1.0:
-                unconditional_conditioning = latent_diffusion.cond_stage_model.get_unconditional_condition(batch_size)
-
-            fnames = list(DDPM.get_input(latent_diffusion, batch, "fname"))
-            _, h, w = z.shape[0], z.shape[2], z.shape[3]
-
-            mask = torch.ones(batch_size, h, w).to(latent_diffusion.device)
-            mask[:, h//2:, :] = 0
-            mask = mask[:, None, ...]
-
-            if batch_idx == 0:
-                samples, _ = latent_diffusion.sample_log(
-                    cond=c,
-                    batch_size=batch_size,
-                    x_T=x_T,
-                    ddim=use_ddim,
-                    ddim_steps=ddim_steps,
-                    eta=ddim_eta,
-                    unconditional_guidance_scale=unconditional_guidance_scale,
-                    unconditional_conditioning=unconditional_conditioning,
-                    use_plms=use_plms,
-                )
-            else:
-                z = torch.cat([z_prev[:, :, h//2:, :], torch.zeros_like(z_prev[:, :, :h//2, :])], dim=2)
-                samples, _ = latent_diffusion.sample_log(
-                    cond=c,
-                    batch_size=batch_size,
-                    x_T=x_T,
-                    ddim=use_ddim,
-                    ddim_steps=ddim_steps,
-                    eta=ddim_eta,
-                    unconditional_guidance_scale=unconditional_guidance_scale,
-                    unconditional_conditioning=unconditional_conditioning,
-                    mask=mask,
-                    use_plms=use_plms,
-                    x0=torch.cat([z] * n_gen, dim=0),
-                )
-
-            mel = latent_diffusion.decode_first_stage(samples)
-            waveform = latent_diffusion.mel_spectrogram_to_waveform(mel, savepath=waveform_save_path, bs=None, name=fnames, save=False)
-
-            similarity = latent_diffusion.cond_stage_model.cos_similarity(torch.FloatTensor(waveform).squeeze(1), text)
-            best_index = [i + torch.argmax(similarity[i::z.shape[0]]).item() * z.shape[0] for i in range(z.shape[0])]
-            waveform = waveform[best_index]
-            z_prev = samples[best_index]
-
-            print("Similarity scores:", similarity)
-            print("Best indexes selected:", best_index)
-
-            latent_diffusion.save_waveform(waveform, waveform_save_path, name=fnames)
-
-            if batch_idx == 0:
-                mel_accum = mel[best_index]
-            else:
-                mel_accum = torch.cat([mel_accum, mel[best_index][:, :, 512:, :]], dim=2)
-
-        waveform_accum = latent_diffusion.mel_spectrogram_to_waveform(
-            mel_accum, savepath=waveform_save_path, bs=None, name="combined_compo", save=False
-        )
-        latent_diffusion.save_waveform(waveform_accum, waveform_save_path, name="combined_compo")
-
+    latent_diffusion.set_precision_policy(precision_policy)
+    if compile_sampling:
+        latent_diffusion.set_compiled_sampling(mode=None if compile_sampling == "auto" else compile_sampling)
+    if deep_cache_interval:
+        latent_diffusion.set_deep_cache(deep_cache_interval, deep_cache_depth)
+
+    waveform_save_path = os.path.join(latent_diffusion.get_log_dir(), name)
+    os.makedirs(waveform_save_path, exist_ok=True)
+
+    # A single composition keeps the original file names
+    def get_prefix(compo_idx):
+        return "" if len(compositions) == 1 else f"compo_{compo_idx}_"
+
+    if resume_state is not None:
+        # a new measurement could batch the compositions differently
+        compositions_per_batch = resume_state["run_settings"]["compositions_per_batch"]
+    else:
+        if batch_memory_gb is not None and memory_per_candidate_gb is None:
+            probe_texts = ["experimental music is playing " + compositions[0][0]] * n_gen
+            memory_per_candidate_gb = measure_memory_per_candidate(latent_diffusion, probe_texts, guidance=unconditional_guidance_scale != 1.0)
+        compositions_per_batch = get_compositions_per_batch(n_gen, batch_memory_gb, memory_per_candidate_gb)
+    print(f"Generating {len(compositions)} composition(s), {compositions_per_batch} per batch of {compositions_per_batch * n_gen} candidates")
+
+    # everything that changes the generated audio must match when resuming
+    run_settings = {
+        "compositions": compositions,
+        "seed": seed,
+        "compositions_per_batch": compositions_per_batch,
+        "sampler": sampler,
+        "ddim_steps": ddim_steps,
+        "dpm_solver_order": dpm_solver_order,
+        "guidance_interval": None if guidance_interval is None else list(guidance_interval),
+        "clap_fp16": clap_fp16,
+        "audio_format": audio_format,
+        "latent_stitching": latent_stitching,
+        "stitching_context": stitching_context,
+        "prune_schedule": prune_schedule,
+        "precision": str(latent_diffusion.precision_policy),
+        "attention_backend": get_attention_backend(),
+        "compile_sampling": compile_sampling,
+        "deep_cache": None if not deep_cache_interval else [deep_cache_interval, deep_cache_depth],
+    }
+    meta_path = os.path.join(log_path, "meta.txt")
+    total_audio_seconds = 0.0
+    scores = []
+    # score/compute trade-off over the run
+    best_scores = []
+    candidate_steps = [0, 0]
+    if resume_state is not None:
+        if resume_state["run_settings"] != run_settings:
+            raise ValueError("--resume must be run with the same prompts and generation options as the original run")
+        with open(meta_path, "r+") as f:
+            f.truncate(resume_state["meta_size"])
+        total_audio_seconds = resume_state["total_audio_seconds"]
+        scores = resume_state["scores"]
+        best_scores = resume_state["best_scores"]
+    start_time = time.time()
+    # file writes, the combined tracks and checkpoints run in the background
+    pipeline = PipelineExecutor(device, enabled=pipelined)
+
+    for group_start in range(0, len(compositions), compositions_per_batch):
+        if resume_state is not None and group_start < resume_state["group_start"]:
+            continue
+        group = list(range(group_start, min(group_start + compositions_per_batch, len(compositions))))
+        z_prev = {}
+        # combined tracks are joined from the vocoded segments and appended to disk
+        combined = {}
+        first_segment = 0
+
+        if resume_state is not None and group_start == resume_state["group_start"]:
+            z_prev = {j: z.to(latent_diffusion.device) for j, z in resume_state["z_prev"].items()}
+            combined = {
+                j: open_combined_track(latent_diffusion, waveform_save_path, f"{get_prefix(j)}combined_compo", audio_format, resume=stream_state)
+                for j, stream_state in resume_state["combined"].items()
+            }
+            first_segment = resume_state["segment_idx"] + 1
+            set_rng_state(resume_state["rng"])
+            print(f"Resuming compositions {group} from segment {first_segment}")
+
+        for segment_idx in range(first_segment, max(len(compositions[j]) for j in group)):
+            # compositions of different lengths drop out of the batch once they are finished
+            active = [j for j in group if segment_idx < len(compositions[j])]
+            n_active = len(active)
+            fnames = [f"{get_prefix(j)}infer_file_{segment_idx}" for j in active]
+            prompts = [compositions[j][segment_idx] for j in active]
+            write_meta(meta_path, fnames, prompts)
+            texts = ["experimental music is playing " + prompt for prompt in prompts]
+
+            with latent_diffusion.ema_scope("Generating"):
+                # Text-only path: the latent shape comes from the config, so no dummy fbank is encoded
+                with pipeline.stage("text_embedding", segment_idx):
+                    c = latent_diffusion.get_learned_conditioning(texts)
+                z_shape = latent_diffusion.get_latent_shape(n_active)
+                # candidates are laid out as [compo_0, ..., compo_n, compo_0, ..., compo_n, ...]
+                c = torch.cat([c] * n_gen, dim=0)
+                batch_size = n_active * n_gen
+
+                unconditional_conditioning = None
+                if unconditional_guidance_scale != 1.0:
+                    unconditional_conditioning = latent_diffusion.cond_stage_model.get_unconditional_condition(batch_size)
+
+                h, w = z_shape[2], z_shape[3]
+
+                mask = torch.ones(batch_size, h, w).to(latent_diffusion.device)
+                mask[:, h//2:, :] = 0
+                mask = mask[:, None, ...]
+
+                # embed the next prompts while sampling, they land in the CLAP text cache
+                next_texts = [
+                    "experimental music is playing " + compositions[j][segment_idx + 1]
+                    for j in active if segment_idx + 1 < len(compositions[j])
+                ]
+                prefetch = None
+                if len(next_texts) > 0:
+                    prefetch = pipeline.submit("prefetch_text", segment_idx + 1, latent_diffusion.cond_stage_model.get_text_embedding, next_texts)
+
+                x0 = None
+                if segment_idx > 0:
+                    z = torch.cat([z_prev[j] for j in active], dim=0)
+                    z = torch.cat([z[:, :, h//2:, :], torch.zeros_like(z[:, :, :h//2, :])], dim=2)
+                    x0 = torch.cat([z] * n_gen, dim=0)
+
+                sampler_kwargs = {}
+                pruner = None
+                if prune_schedule:
+                    pruner = CandidatePruner(
+                        latent_diffusion, c, n_active, prune_schedule, ddim_steps,
+                        x0=x0, mask=mask if x0 is not None else None,
+                    )
+                    sampler_kwargs["prune_callback"] = pruner
+
+                with pipeline.stage("sampling", segment_idx):
+                    if segment_idx == 0:
+                        samples, _ = latent_diffusion.sample_log(
+                            cond=c,
+                            batch_size=batch_size,
+                            x_T=x_T,
+                            ddim=use_ddim,
+                            ddim_steps=ddim_steps,
+                            eta=ddim_eta,
+                            unconditional_guidance_scale=unconditional_guidance_scale,
+                            unconditional_conditioning=unconditional_conditioning,
+                            use_plms=use_plms,
+                            guidance_interval=guidance_interval,
+                            use_dpm_solver=use_dpm_solver,
+                            dpm_solver_order=dpm_solver_order,
+                            **sampler_kwargs,
+                        )
+                    else:
+                        samples, _ = latent_diffusion.sample_log(
+                            cond=c,
+                            batch_size=batch_size,
+                            x_T=x_T,
+                            ddim=use_ddim,
+                            ddim_steps=ddim_steps,
+                            eta=ddim_eta,
+                            unconditional_guidance_scale=unconditional_guidance_scale,
+                            unconditional_conditioning=unconditional_conditioning,
+                            mask=mask,
+                            use_plms=use_plms,
+                            x0=x0,
+                            guidance_interval=guidance_interval,
+                            use_dpm_solver=use_dpm_solver,
+                            dpm_solver_order=dpm_solver_order,
+                            **sampler_kwargs,
+                        )
+
+                # with pruning only the surviving candidates come back, in the same layout
+                n_candidates = samples.shape[0] // n_active
+                text = texts * n_candidates
+                if pruner is not None:
+                    report = pruner.report()
+                    candidate_steps[0] += report["unet_candidate_steps"]
+                    candidate_steps[1] += report["unet_candidate_steps_without_pruning"]
+                    print("Pruning:", report)
+
+                if prefetch is not None:
+                    # surface prefetch errors here; the text cache itself is locked
+                    prefetch.result()
+
+                if latent_stitching and segment_idx > 0:
+                    # only the new half is kept, so decode and vocode just that plus some context.
+                    # Candidates are then scored with CLAP on the new audio alone instead of the
+                    # whole segment, so the selected candidate can differ from a full decode run.
+                    with pipeline.stage("decode", segment_idx):
+                        mel, n_context = latent_diffusion.decode_first_stage_partial(samples, h//2, stitching_context)
+                    with pipeline.stage("vocode", segment_idx):
+                        waveform = latent_diffusion.mel_spectrogram_to_waveform(mel, savepath=waveform_save_path, bs=None, name=fnames, save=False)
+                    hop = waveform.shape[-1] // mel.size(2)
+                    # the combined track crossfades over the context audio
+                    track_waveform, track_start = waveform, n_context * hop
+                    mel, waveform = mel[:, :, n_context:, :], waveform[..., n_context * hop:]
+                    if check_stitching:
+                        # raises, and ends the run, when the kept audio is further from a full decode than the tolerances
+                        print("Latent stitching check:", latent_diffusion.check_partial_decode(
+                            samples, h//2, stitching_context, mel_tolerance=stitching_mel_tolerance, min_snr_db=stitching_min_snr_db,
+                        ))
+                else:
+                    with pipeline.stage("decode", segment_idx):
+                        mel = latent_diffusion.decode_first_stage(samples)
+                    with pipeline.stage("vocode", segment_idx):
+                        waveform = latent_diffusion.mel_spectrogram_to_waveform(mel, savepath=waveform_save_path, bs=None, name=fnames, save=False)
+                    # a continuation repeats the previous segment's second half, the combined track crossfades over it
+                    track_waveform, track_start = waveform, 0 if segment_idx == 0 else waveform.shape[-1] // 2
+
+                with pipeline.stage("clap_scoring", segment_idx):
+                    similarity = latent_diffusion.cond_stage_model.cos_similarity(torch.FloatTensor(waveform).squeeze(1), text).view(-1)
+                    best_index = [i + torch.argmax(similarity[i::n_active]).item() * n_active for i in range(n_active)]
+                waveform = waveform[best_index]
+
+                print("Similarity scores:", similarity)
+                print("Best indexes selected:", best_index)
+                scores.append({
+                    "segment": segment_idx,
+                    "compositions": active,
+                    "similarity": similarity.cpu(),
+                    "best_index": best_index,
+                    "pruning": None if pruner is None else pruner.history,
+                })
+                best_scores.extend(similarity[best_index].tolist())
+
+                pipeline.submit("save_segments", segment_idx, latent_diffusion.save_waveform, waveform, waveform_save_path, fnames)
+
+                for i, j in enumerate(active):
+                    z_prev[j] = samples[best_index[i]:best_index[i] + 1]
+                    if len(compositions) > 1 and len(compositions[j]) == 1:
+                        continue  # a single-segment piece is its own combined track
+                    if segment_idx == 0:
+                        combined[j] = open_combined_track(latent_diffusion, waveform_save_path, f"{get_prefix(j)}combined_compo", audio_format)
+                    track_new = track_waveform[best_index[i]:best_index[i] + 1]
+                    pipeline.submit("combined_track", segment_idx, combined[j].push, track_new, track_start)
+
+            for j in active:
+                if j in combined and segment_idx == len(compositions[j]) - 1:
+                    pipeline.submit("combined_track", segment_idx, close_combined_track, combined.pop(j))
+
+            # only the newly generated half of a continuation segment is new audio
+            new_samples = waveform.shape[-1] if segment_idx == 0 or latent_stitching else waveform.shape[-1] // 2
+            total_audio_seconds += n_active * new_samples / 16000
+            elapsed = time.time() - start_time
+            print(f"Throughput: {total_audio_seconds:.1f} s of audio in {elapsed:.1f} s ({total_audio_seconds / elapsed:.3f} s audio / s)")
+
+            # queued after this segment's writes, with the state as of now
+            checkpoint = {
+                "run_settings": run_settings,
+                "group_start": group_start,
+                "segment_idx": segment_idx,
+                "z_prev": dict(z_prev),
+                "combined": dict(combined),
+                "rng": get_rng_state(),
+                "scores": list(scores),
+                "best_scores": list(best_scores),
+                "meta_size": os.path.getsize(meta_path),
+                "total_audio_seconds": total_audio_seconds,
+            }
+            pipeline.submit("checkpoint", segment_idx, save_checkpoint, log_path, checkpoint, tensors=list(z_prev.values()))
+
+    pipeline.close()
+    pipeline.print_summary()
+    pipeline.save_timeline(os.path.join(log_path, "timeline.json"))
+
+    if len(best_scores) > 0:
+        print(f"Mean CLAP score of the selected candidates: {np.mean(best_scores):.4f}")
+    if prune_schedule:
+        print(f"UNet candidate-steps: {candidate_steps[0]} of {candidate_steps[1]} without pruning ({candidate_steps[1] / max(1, candidate_steps[0]):.2f}x less)")
+    print("CLAP text embedding cache:", latent_diffusion.cond_stage_model.embedding_cache_info())
     print(f"Generation complete. Samples and metadata saved at: {log_path}")
 
 
@@ -222,8 +477,34 @@ def print_license():
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--text", type=str, default="", help="Single text prompt")
-    parser.add_argument("--texts", type=str, default="", help="Path to file with multiple prompts")
+    parser.add_argument("--texts", type=str, nargs="+", default=[], help="Path to file with multiple prompts. Several files generate several compositions in parallel")
+    parser.add_argument("--independent", action="store_true", help="Treat every prompt as its own single-segment piece instead of continuing one composition")
+    parser.add_argument("--batch_memory_gb", type=float, default=None, help="Memory budget for one batched sampling call; compositions are batched together to fill it")
+    parser.add_argument("--memory_per_candidate_gb", type=float, default=None, help="Memory of one candidate, used with --batch_memory_gb (default: measured with a probe on CUDA, scaled from the 256x16 latent estimate on CPU)")
+    parser.add_argument("--guidance_interval", type=float, nargs=2, default=None, metavar=("LO", "HI"), help="Only apply classifier-free guidance for diffusion times t/T in [LO, HI]; other steps skip the unconditional pass (ddim only)")
+    parser.add_argument("--sampler", type=str, default="ddim", choices=["ddim", "plms", "dpm_solver"], help="Sampler used for every segment")
+    parser.add_argument("--steps", type=int, default=None, help="Number of sampling steps (defaults to ddim_sampling_steps in the config; 20-25 is enough for dpm_solver)")
+    parser.add_argument("--dpm_solver_order", type=int, default=2, choices=[2, 3], help="Order of the multistep DPM-Solver++")
+    parser.add_argument("--clap_fp16", action="store_true", help="Run CLAP in fp16 on GPU, same as clap=fp16 in --precision")
+    parser.add_argument("--precision", type=str, default="fp32", help="Compute precision, fp32, bf16 or fp16 for every component, or per component e.g. unet=bf16,vae=bf16,vocoder=fp32,clap=fp16 (see validate_precision.py)")
+    parser.add_argument("--attention", type=str, default=None, choices=ATTENTION_BACKENDS, help="Attention backend of the UNet and VAE (default: sdpa with torch>=2.0); einsum is the original implementation, see benchmark_unet.py")
+    parser.add_argument("--attention_chunk_mb", type=int, default=None, help="Attention matrix memory cap of the chunked backend")
+    parser.add_argument("--compile", type=str, nargs="?", const="auto", default=None, choices=["auto"] + COMPILE_MODES, help="Run the ddim steps through torch.compile, traced once per batch and reused across segments; auto uses CUDA graphs (reduce-overhead) on CUDA and the inductor CPU backend otherwise")
+    parser.add_argument("--deep_cache_interval", type=int, default=None, help="Approximate ddim sampling: run the full UNet every N steps and only its shallow blocks on the cached deep features in between (see validate_deep_cache.py)")
+    parser.add_argument("--deep_cache_depth", type=int, default=3, help="Input and output blocks of the UNet that are recomputed on cached steps")
+    parser.add_argument("--audio_format", type=str, default="wav", choices=["wav", "flac"], help="File format of the combined composition tracks, which are appended to while generating (--resume needs wav)")
+    parser.add_argument("--latent_stitching", action="store_true", help="For continuation segments, only decode and vocode the newly generated latent frames (plus context) instead of the full segment; candidates are then CLAP-scored on the new audio only")
+    parser.add_argument("--stitching_context", type=int, default=32, help="Latent frames of left context decoded with --latent_stitching")
+    parser.add_argument("--check_stitching", action="store_true", help="With --latent_stitching, also decode every continuation in full and stop with an error when the kept audio is further from it than the tolerances below")
+    parser.add_argument("--stitching_mel_tolerance", type=float, default=0.5, help="Largest log-mel difference to the full decode accepted by --check_stitching")
+    parser.add_argument("--stitching_min_snr_db", type=float, default=15.0, help="Smallest waveform SNR against the full decode accepted by --check_stitching")
+    parser.add_argument("--sequential", action="store_true", help="Run file writes, combined tracks and checkpoints inline instead of in a background pipeline")
+    parser.add_argument("--prune_schedule", type=str, nargs="+", default=None, metavar="FRACTION:KEEP_RATIO", help="Best-of-N pruning for the ddim sampler: after each FRACTION of the steps, score pred_x0 with CLAP and keep the best KEEP_RATIO of the candidates, e.g. 0.2:0.4 0.5:0.5")
+    parser.add_argument("--weights", type=str, default=None, help="Build an inference-only model from a bundle written by convert_musicldm_checkpoint.py instead of the training checkpoints")
+    parser.add_argument("--resume", type=int, default=None, metavar="LOG_ID", help="Continue an interrupted run in lightning_logs/musicldm_inference_logs/LOG_ID from its last completed segment")
     parser.add_argument("--seed", type=int, default=0, help="Random seed for generation")
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu", help="Device to run generation on, e.g. cuda:0 or cpu")
+    parser.add_argument("--cpu_threads", type=int, default=None, help="Number of intra-op threads when running on CPU")
     args = parser.parse_args()
 
     if args.text and args.texts:
@@ -231,12 +512,45 @@ if __name__ == "__main__":
 
     if args.text:
         print_license()
-        texts = [args.text]
+        compositions = [[args.text]]
     elif args.texts:
         print_license()
-        texts = np.genfromtxt(args.texts, dtype=str, delimiter="\n")
+        compositions = [read_prompts(path) for path in args.texts]
     else:
         raise ValueError("You must provide either --text or --texts")
 
+    if args.independent:
+        compositions = [[prompt] for compo in compositions for prompt in compo]
+
+    prepare_checkpoints()
     config = yaml.load(open(CONFIG_PATH, 'r'), Loader=yaml.FullLoader)
-    main(config, texts, args.seed)
+    main(
+        config,
+        compositions,
+        args.seed,
+        device=args.device,
+        cpu_threads=args.cpu_threads,
+        batch_memory_gb=args.batch_memory_gb,
+        memory_per_candidate_gb=args.memory_per_candidate_gb,
+        guidance_interval=args.guidance_interval,
+        sampler=args.sampler,
+        steps=args.steps,
+        dpm_solver_order=args.dpm_solver_order,
+        clap_fp16=args.clap_fp16,
+        resume=args.resume,
+        audio_format=args.audio_format,
+        latent_stitching=args.latent_stitching,
+        stitching_context=args.stitching_context,
+        check_stitching=args.check_stitching,
+        stitching_mel_tolerance=args.stitching_mel_tolerance,
+        stitching_min_snr_db=args.stitching_min_snr_db,
+        pipelined=not args.sequential,
+        prune_schedule=None if args.prune_schedule is None else parse_prune_schedule(args.prune_schedule),
+        weights=args.weights,
+        precision=args.precision,
+        attention_backend=args.attention,
+        attention_chunk_mb=args.attention_chunk_mb,
+        compile_sampling=args.compile,
+        deep_cache_interval=args.deep_cache_interval,
+        deep_cache_depth=args.deep_cache_depth,
+    )
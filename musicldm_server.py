@@ -0,0 +1,470 @@
+"""
+Long-lived MusicLDM generation service.
+
+Loads MusicLDM once and keeps it warm. Prompt or prompt-list jobs are sent
+over HTTP (TCP or a Unix socket). Concurrent jobs are batched into shared
+sample_log calls at every segment boundary, so a job that arrives while
+others are running joins the next batch. Finished segments are streamed back
+as newline-delimited JSON.
+
+    POST /generate             {"prompt": "..."} or {"prompts": ["...", ...]}, "stream": true|false
+    GET  /jobs/<id>            job status
+    GET  /jobs/<id>/<file>     a finished segment or combined track (wav)
+    GET  /metrics              queue depth, latency percentiles, GPU memory
+"""
+
+import sys
+sys.path.append("src")
+
+import os
+import json
+import time
+import queue
+import argparse
+import itertools
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+import yaml
+
+from src.latent_diffusion.models.musicldm import MusicLDM
+from latent_diffusion.models.inference import build_inference_model
+from latent_diffusion.models.compiled_ddim import COMPILE_MODES
+from latent_diffusion.modules.precision import PrecisionPolicy
+from latent_diffusion.modules.attention_backends import BACKENDS as ATTENTION_BACKENDS, set_attention_backend
+from utilities.runtime import CONFIG_PATH, close_combined_track, open_combined_track, prepare_checkpoints
+
+
+class Job:
+    def __init__(self, job_id, prompts, save_path):
+        self.id = job_id
+        self.prompts = prompts
+        self.save_path = save_path
+        self.segment_idx = 0
+        self.z_prev = None
+        self.combined = None
+        self.files = []
+        self.scores = []
+        self.events = queue.Queue()
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    @property
+    def done(self):
+        return self.segment_idx >= len(self.prompts)
+
+    def status(self):
+        return {
+            "job_id": self.id,
+            "prompts": self.prompts,
+            "segments_done": self.segment_idx,
+            "segments_total": len(self.prompts),
+            "files": self.files,
+            "scores": self.scores,
+            "done": self.done,
+        }
+
+
+class Metrics:
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.segment_latency = []
+        self.job_latency = []
+        self.queue_wait = []
+        self.batch_sizes = []
+        self.window = window
+        self.jobs_completed = 0
+        self.segments_generated = 0
+
+    def add(self, name, value):
+        with self.lock:
+            values = getattr(self, name)
+            values.append(value)
+            del values[: -self.window]
+
+    def increment(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    @staticmethod
+    def percentiles(values):
+        if len(values) == 0:
+            return None
+        return {
+            "p50": float(np.percentile(values, 50)),
+            "p90": float(np.percentile(values, 90)),
+            "p99": float(np.percentile(values, 99)),
+        }
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "segment_latency_s": self.percentiles(self.segment_latency),
+                "job_latency_s": self.percentiles(self.job_latency),
+                "queue_wait_s": self.percentiles(self.queue_wait),
+                "mean_batch_size": float(np.mean(self.batch_sizes)) if self.batch_sizes else None,
+                "jobs_completed": self.jobs_completed,
+                "segments_generated": self.segments_generated,
+            }
+
+
+class GenerationService:
+    """Owns the model and a scheduler thread that batches the next segment of every active job."""
+
+    def __init__(self, config, device, log_path, steps=None, sampler="ddim", max_batch_compositions=4, batch_wait_ms=50, weights=None, precision="fp32", compile_sampling=None, deep_cache_interval=None, deep_cache_depth=3):
+        self.device = torch.device(device)
+        self.log_path = log_path
+        self.max_batch_compositions = max_batch_compositions
+        self.batch_wait = batch_wait_ms / 1000
+
+        if weights is None:
+            self.model = MusicLDM(**config["model"]["params"])
+            self.model.bake_ema()
+            self.model.to(self.device).eval()
+        else:
+            self.model = build_inference_model(config, weights, self.device)
+        self.model.set_log_dir(log_path, log_path, log_path)
+        if self.model.model.conditioning_key and self.model.cond_stage_key_orig == "waveform":
+            self.model.cond_stage_key = "text"
+            self.model.cond_stage_model.embed_mode = "text"
+        self.model.set_precision_policy(PrecisionPolicy.parse(precision))
+        if compile_sampling:
+            if sampler != "ddim":
+                raise ValueError("Compiled sampling is only supported with the ddim sampler")
+            # one compiled step per batch size, traced by the first request of that size
+            self.model.set_compiled_sampling(mode=None if compile_sampling == "auto" else compile_sampling)
+        if deep_cache_interval:
+            if sampler != "ddim":
+                raise ValueError("The deep feature cache is only supported with the ddim sampler")
+            self.model.set_deep_cache(deep_cache_interval, deep_cache_depth)
+
+        params = self.model.evaluation_params
+        self.ddim_steps = steps if steps is not None else params["ddim_sampling_steps"]
+        self.n_gen = params["n_candidates_per_samples"]
+        self.guidance_scale = params["unconditional_guidance_scale"]
+        self.sampler = sampler
+
+        self.jobs = {}
+        self.active = []
+        self.job_ids = itertools.count()
+        self.lock = threading.Condition()
+        self.metrics = Metrics()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="scheduler", daemon=True)
+        self.thread.start()
+
+    def submit(self, prompts):
+        with self.lock:
+            job_id = str(next(self.job_ids))
+            save_path = os.path.join(self.log_path, "jobs", job_id)
+            os.makedirs(save_path, exist_ok=True)
+            job = Job(job_id, prompts, save_path)
+            self.jobs[job_id] = job
+            self.active.append(job)
+            self.lock.notify()
+        return job
+
+    def run(self):
+        while self.running:
+            with self.lock:
+                while self.running and len(self.active) == 0:
+                    self.lock.wait()
+                if not self.running:
+                    return
+                new_jobs = any(job.started is None for job in self.active)
+            if new_jobs:
+                # a new batch is forming, give concurrent requests a moment to join it;
+                # running jobs go straight on to their next segment
+                time.sleep(self.batch_wait)
+            with self.lock:
+                batch = self.active[: self.max_batch_compositions]
+            try:
+                self.step(batch)
+            except Exception as e:
+                print(f"Generation failed for jobs {[job.id for job in batch]}: {e}")
+                with self.lock:
+                    for job in batch:
+                        if job in self.active:
+                            self.active.remove(job)
+                for job in batch:
+                    self.close_failed_job(job)
+                    job.events.put({"job_id": job.id, "error": str(e), "done": True})
+
+    def close_failed_job(self, job):
+        # finish the combined track written so far, so its file is closed and its header valid
+        if job.combined is None or job.done:
+            return
+        try:
+            close_combined_track(job.combined)
+        except Exception as e:
+            print(f"Could not close the combined track of job {job.id}: {e}")
+        job.combined = None
+        job.finished = time.time()
+
+    @torch.no_grad()
+    def step(self, batch):
+        start = time.time()
+        for job in batch:
+            if job.started is None:
+                job.started = start
+                self.metrics.add("queue_wait", start - job.submitted)
+
+        model = self.model
+        n_active = len(batch)
+        texts = ["experimental music is playing " + job.prompts[job.segment_idx] for job in batch]
+        batch_size = n_active * self.n_gen
+
+        with model.ema_scope("Generating"):
+            c = model.get_learned_conditioning(texts)
+            c = torch.cat([c] * self.n_gen, dim=0)
+            z_shape = model.get_latent_shape(n_active)
+            h = z_shape[2]
+
+            unconditional_conditioning = None
+            if self.guidance_scale != 1.0:
+                unconditional_conditioning = model.cond_stage_model.get_unconditional_condition(batch_size)
+
+            # first segments and continuations share one batch: a first segment keeps nothing
+            mask, x0 = None, None
+            if any(job.z_prev is not None for job in batch):
+                z = torch.zeros(z_shape, device=model.device)
+                keep = torch.zeros(n_active, 1, h, z_shape[3], device=model.device)
+                for i, job in enumerate(batch):
+                    if job.z_prev is not None:
+                        z[i, :, : h // 2] = job.z_prev[0, :, h // 2 :]
+                        keep[i, :, : h // 2] = 1
+                x0 = torch.cat([z] * self.n_gen, dim=0)
+                mask = torch.cat([keep] * self.n_gen, dim=0)
+
+            samples, _ = model.sample_log(
+                cond=c,
+                batch_size=batch_size,
+                x_T=None,
+                ddim=self.ddim_steps is not None,
+                ddim_steps=self.ddim_steps,
+                eta=1.0,
+                unconditional_guidance_scale=self.guidance_scale,
+                unconditional_conditioning=unconditional_conditioning,
+                mask=mask,
+                x0=x0,
+                use_plms=self.sampler == "plms",
+                use_dpm_solver=self.sampler == "dpm_solver",
+            )
+            mel = model.decode_first_stage(samples)
+            waveform = model.mel_spectrogram_to_waveform(mel, save=False)
+            similarity = model.cond_stage_model.cos_similarity(
+                torch.FloatTensor(waveform).squeeze(1), texts * self.n_gen
+            ).view(-1)
+            best_index = [i + torch.argmax(similarity[i::n_active]).item() * n_active for i in range(n_active)]
+
+        latency = time.time() - start
+        self.metrics.add("segment_latency", latency)
+        self.metrics.add("batch_sizes", n_active)
+
+        for i, job in enumerate(batch):
+            best = best_index[i]
+            fname = f"infer_file_{job.segment_idx}"
+            model.save_waveform(waveform[best : best + 1], job.save_path, name=[fname])
+            if job.combined is None:
+                job.combined = open_combined_track(model, job.save_path, "combined_compo")
+                job.combined.push(waveform[best : best + 1])
+            else:
+                # the first half repeats the previous segment, the track crossfades over it
+                job.combined.push(waveform[best : best + 1], waveform.shape[-1] // 2)
+            job.z_prev = samples[best : best + 1]
+            job.files.append(fname + ".wav")
+            job.scores.append(similarity[best].item())
+            event = {
+                "job_id": job.id,
+                "segment": job.segment_idx,
+                "prompt": job.prompts[job.segment_idx],
+                "file": f"/jobs/{job.id}/{fname}.wav",
+                "clap_score": job.scores[-1],
+                "latency_s": latency,
+                "batch_size": n_active,
+            }
+            job.segment_idx += 1
+            self.metrics.increment("segments_generated")
+
+            if job.done:
+                close_combined_track(job.combined)
+                combined_name = os.path.basename(job.combined.writer.path)
+                job.files.append(combined_name)
+                job.finished = time.time()
+                self.metrics.add("job_latency", job.finished - job.submitted)
+                self.metrics.increment("jobs_completed")
+                with self.lock:
+                    self.active.remove(job)
+                event["combined"] = f"/jobs/{job.id}/{combined_name}"
+                event["done"] = True
+            job.events.put(event)
+
+        # rotate so jobs beyond max_batch_compositions get their turn
+        with self.lock:
+            for job in batch:
+                if job in self.active:
+                    self.active.remove(job)
+                    self.active.append(job)
+
+    def metrics_snapshot(self):
+        snapshot = self.metrics.snapshot()
+        with self.lock:
+            snapshot["active_jobs"] = len(self.active)
+            snapshot["queue_depth"] = sum(1 for job in self.active if job.started is None)
+        if self.device.type == "cuda":
+            snapshot["gpu_memory_allocated_mb"] = torch.cuda.memory_allocated(self.device) / 2**20
+            snapshot["gpu_memory_reserved_mb"] = torch.cuda.memory_reserved(self.device) / 2**20
+            snapshot["gpu_max_memory_allocated_mb"] = torch.cuda.max_memory_allocated(self.device) / 2**20
+        return snapshot
+
+    def shutdown(self):
+        with self.lock:
+            self.running = False
+            self.lock.notify()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    service = None
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        # Unix sockets have no client address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_chunk(self, obj):
+        data = (json.dumps(obj) + "\n").encode()
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_POST(self):
+        if self.path != "/generate":
+            return self.send_json({"error": "not found"}, 404)
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if not isinstance(request, dict):
+                raise ValueError("the body must be a JSON object")
+            prompts = request["prompts"] if "prompts" in request else [request["prompt"]]
+            if not isinstance(prompts, list) or len(prompts) == 0:
+                raise ValueError("prompts must be a non-empty list")
+        except (ValueError, KeyError) as e:
+            return self.send_json({"error": "bad request: %s" % e}, 400)
+
+        job = self.service.submit([str(p) for p in prompts])
+        if not request.get("stream", True):
+            return self.send_json({"job_id": job.id, "status": f"/jobs/{job.id}"}, 202)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.write_chunk({"job_id": job.id, "queued": True})
+        while True:
+            event = job.events.get()
+            self.write_chunk(event)
+            if event.get("done"):
+                break
+        self.wfile.write(b"0\r\n\r\n")
+
+    def do_GET(self):
+        parts = [p for p in self.path.split("/") if p]
+        if parts == ["metrics"]:
+            return self.send_json(self.service.metrics_snapshot())
+        if len(parts) >= 2 and parts[0] == "jobs" and parts[1] in self.service.jobs:
+            job = self.service.jobs[parts[1]]
+            if len(parts) == 2:
+                return self.send_json(job.status())
+            if len(parts) == 3 and parts[2] in job.files:
+                with open(os.path.join(job.save_path, parts[2]), "rb") as f:
+                    body = f.read()
+                self.send_response(200)
+                self.send_header("Content-Type", "audio/wav")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+        self.send_json({"error": "not found"}, 404)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve MusicLDM generation over HTTP")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix_socket", type=str, default=None, help="Listen on this Unix socket path instead of TCP")
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--sampler", type=str, default="ddim", choices=["ddim", "plms", "dpm_solver"])
+    parser.add_argument("--steps", type=int, default=None, help="Sampling steps (defaults to ddim_sampling_steps in the config)")
+    parser.add_argument("--max_batch_compositions", type=int, default=4, help="Most jobs sampled together in one sample_log call")
+    parser.add_argument("--batch_wait_ms", type=float, default=50, help="How long to wait for concurrent requests before sampling a batch")
+    parser.add_argument("--precision", type=str, default="fp32", help="fp32, bf16, fp16 or per component, e.g. unet=bf16,vae=bf16,vocoder=fp32,clap=fp16")
+    parser.add_argument("--attention", type=str, default=None, choices=ATTENTION_BACKENDS, help="Attention backend of the UNet and VAE (default: sdpa with torch>=2.0)")
+    parser.add_argument("--attention_chunk_mb", type=int, default=None, help="Attention matrix memory cap of the chunked backend")
+    parser.add_argument("--compile", type=str, nargs="?", const="auto", default=None, choices=["auto"] + COMPILE_MODES, help="Run the ddim steps through torch.compile (auto: CUDA graphs on CUDA, inductor on CPU)")
+    parser.add_argument("--deep_cache_interval", type=int, default=None, help="Run the full UNet every N ddim steps and only its shallow blocks in between (approximate)")
+    parser.add_argument("--deep_cache_depth", type=int, default=3, help="UNet input and output blocks recomputed on cached steps")
+    parser.add_argument("--weights", type=str, default=None, help="Inference bundle written by convert_musicldm_checkpoint.py, for a faster startup")
+    args = parser.parse_args()
+
+    log_path = "lightning_logs/musicldm_server_logs"
+    os.makedirs(log_path, exist_ok=True)
+    log_id = 0
+    while str(log_id) in os.listdir(log_path):
+        log_id += 1
+    log_path = os.path.join(log_path, str(log_id))
+    os.makedirs(log_path, exist_ok=True)
+
+    if args.attention is not None:
+        set_attention_backend(args.attention, args.attention_chunk_mb)
+    prepare_checkpoints()
+    config = yaml.load(open(CONFIG_PATH, "r"), Loader=yaml.FullLoader)
+    service = GenerationService(
+        config,
+        args.device,
+        log_path,
+        steps=args.steps,
+        sampler=args.sampler,
+        max_batch_compositions=args.max_batch_compositions,
+        batch_wait_ms=args.batch_wait_ms,
+        weights=args.weights,
+        precision=args.precision,
+        compile_sampling=args.compile,
+        deep_cache_interval=args.deep_cache_interval,
+        deep_cache_depth=args.deep_cache_depth,
+    )
+    RequestHandler.service = service
+
+    if args.unix_socket is not None:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = ThreadingUnixHTTPServer(args.unix_socket, RequestHandler)
+        print(f"MusicLDM server listening on unix:{args.unix_socket}, outputs in {log_path}")
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+        print(f"MusicLDM server listening on http://{args.host}:{args.port}, outputs in {log_path}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -77,7 +77,8 @@ def create_model(
     pretrained_audio: str = "",
     pretrained_text: str = "",
     enable_fusion: bool = False,
-    fusion_type: str = 'None'
+    fusion_type: str = 'None',
+    text_config_path: str = None,
     # pretrained_image: bool = False,
 ):
     amodel_name = amodel_name.replace(
@@ -131,6 +132,7 @@ def create_model(
         #     else:
         #         assert False, 'pretrained image towers currently only supported for timm models'
         model_cfg["text_cfg"]["model_type"] = tmodel_name
+        model_cfg["text_cfg"]["config_path"] = text_config_path
         model_cfg["enable_fusion"] = enable_fusion
         model_cfg["fusion_type"] = fusion_type
         model = CLAP(**model_cfg)
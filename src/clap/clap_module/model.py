@@ -20,7 +20,7 @@ from .utils import freeze_batch_norm_2d
 
 from .pann_model import create_pann_model
 from .htsat import create_htsat_model
-from transformers import BertModel, RobertaModel, BartModel
+from transformers import BertModel, RobertaConfig, RobertaModel, BartModel
 from transformers.tokenization_utils_base import BatchEncoding
 
 
@@ -417,6 +417,8 @@ class CLAPTextCfg:
     heads: int
     layers: int
     model_type: str
+    # directory with the Hugging Face config of the text branch, weights are then left to the CLAP checkpoint
+    config_path: str = None
 
 
 class CLAP(nn.Module):
@@ -503,7 +505,10 @@ class CLAP(nn.Module):
                 nn.Linear(self.joint_embed_shape, self.joint_embed_shape)
             )
         elif text_cfg.model_type == "roberta":
-            self.text_branch = RobertaModel.from_pretrained('roberta-base')
+            if text_cfg.config_path is not None:
+                self.text_branch = RobertaModel(RobertaConfig.from_pretrained(text_cfg.config_path))
+            else:
+                self.text_branch = RobertaModel.from_pretrained('roberta-base')
             self.text_transform = MLPLayers(units=[self.joint_embed_shape,
                                                    self.joint_embed_shape,
                                                    self.joint_embed_shape], dropout=0.1)
@@ -1,4 +1,5 @@
 from .models import Generator
+from .streaming import CrossfadeTrack, StreamingVocoder, receptive_field_frames
 
 
 class AttrDict(dict):
@@ -0,0 +1,172 @@
+import math
+
+import numpy as np
+import torch
+
+
+def receptive_field_frames(h):
+    # One-sided receptive field of the Generator, in mel frames
+    rf = 3.0  # conv_pre, kernel 7
+    hop = 1
+    for u, k in zip(h.upsample_rates, h.upsample_kernel_sizes):
+        hop *= u
+        rf += (k // 2) / hop
+        rf += max(
+            sum((kr - 1) * d // 2 + (kr - 1) // 2 for d in dilations)
+            for kr, dilations in zip(h.resblock_kernel_sizes, h.resblock_dilation_sizes)
+        ) / hop
+    rf += 3 / hop  # conv_post, kernel 7
+    return int(math.ceil(rf))
+
+
+class StreamingVocoder:
+    """Vocode a mel spectrogram that arrives in chunks.
+
+    Every window is vocoded with `context_frames` of mel on both sides of the
+    emitted region, so the output matches a single full-length decode apart
+    from float noise. Consecutive windows are crossfaded over `crossfade_frames`.
+    Only the context frames are vocoded more than once.
+    """
+
+    def __init__(self, vocoder, context_frames=None, crossfade_frames=8, sink=None):
+        self.vocoder = vocoder
+        self.hop = int(math.prod(vocoder.h.upsample_rates))
+        self.context = (
+            receptive_field_frames(vocoder.h) if context_frames is None else context_frames
+        )
+        self.crossfade = crossfade_frames
+        # sink(chunk) receives every emitted chunk as a float numpy array [bs, samples]
+        self.sink = sink
+        self.reset()
+
+    def reset(self):
+        # mel: [bs, fbins, t], the first `left` frames are context that was already emitted
+        self.mel = None
+        self.left = 0
+        # vocoded audio of the crossfade region, blended into the next chunk
+        self.pending = None
+        self.samples_out = 0
+
+    def state_dict(self):
+        return {
+            "mel": None if self.mel is None else self.mel.cpu(),
+            "left": self.left,
+            "pending": None if self.pending is None else self.pending.cpu(),
+            "samples_out": self.samples_out,
+        }
+
+    def load_state_dict(self, state, device=None):
+        self.mel = None if state["mel"] is None else state["mel"].to(device)
+        self.left = state["left"]
+        self.pending = None if state["pending"] is None else state["pending"].to(device)
+        self.samples_out = state["samples_out"]
+
+    def push(self, mel):
+        # mel: [bs, 1, t-steps, fbins]
+        if len(mel.size()) == 4:
+            mel = mel.squeeze(1)
+        mel = mel.permute(0, 2, 1)
+        self.mel = mel if self.mel is None else torch.cat([self.mel, mel], dim=2)
+
+        # frames whose right context is complete
+        n_ready = self.mel.size(2) - self.left - self.context - self.crossfade
+        if n_ready < max(1, self.crossfade):
+            return None
+        return self._emit(n_ready, final=False)
+
+    def flush(self):
+        if self.mel is None or self.mel.size(2) == self.left:
+            self.reset()
+            return None
+        chunk = self._emit(self.mel.size(2) - self.left, final=True)
+        self.reset()
+        return chunk
+
+    def _emit(self, n_frames, final):
+        end = self.left + n_frames
+        window = self.mel if final else self.mel[:, :, : end + self.crossfade + self.context]
+        with torch.no_grad():
+            audio = self.vocoder(window).squeeze(1)
+
+        chunk = audio[:, self.left * self.hop : end * self.hop]
+        tail = None if final else audio[:, end * self.hop : (end + self.crossfade) * self.hop]
+
+        if self.pending is not None and self.pending.size(1) > 0:
+            length = self.pending.size(1)
+            fade = torch.linspace(0.0, 1.0, length, device=chunk.device, dtype=chunk.dtype)
+            chunk = chunk.clone()
+            chunk[:, :length] = self.pending * (1.0 - fade) + chunk[:, :length] * fade
+        self.pending = tail
+
+        # keep only the left context needed by the next window
+        keep_from = max(0, end - self.context)
+        self.mel = self.mel[:, :, keep_from:]
+        self.left = end - keep_from
+
+        chunk = chunk.cpu().detach().numpy()
+        self.samples_out += chunk.shape[1]
+        if self.sink is not None:
+            self.sink(chunk)
+        return chunk
+
+
+class CrossfadeTrack:
+    """Join segment waveforms that were already vocoded into one track.
+
+    Every pushed waveform starts with `start` samples that overlap the end of
+    the audio pushed before (the kept half of a continuation segment, or the
+    decode context with latent stitching). The last `crossfade_samples` of
+    every push are held back and crossfaded into that overlap on the next
+    push, so the seams are smooth and no mel frame is vocoded again, unlike
+    StreamingVocoder, which vocodes the mel a second time.
+    """
+
+    def __init__(self, crossfade_samples=1280, sink=None):
+        self.crossfade = crossfade_samples
+        # sink(chunk) receives every emitted chunk as a float numpy array [bs, samples]
+        self.sink = sink
+        self.reset()
+
+    def reset(self):
+        # end of the audio pushed so far, blended into the next push
+        self.pending = None
+        self.samples_out = 0
+
+    def state_dict(self):
+        return {
+            "pending": None if self.pending is None else torch.from_numpy(self.pending.copy()),
+            "samples_out": self.samples_out,
+        }
+
+    def load_state_dict(self, state, device=None):
+        self.pending = None if state["pending"] is None else state["pending"].cpu().numpy()
+        self.samples_out = state["samples_out"]
+
+    def push(self, waveform, start=0):
+        # waveform: [bs, 1, samples] or [bs, samples], the first `start` samples are overlap
+        waveform = np.asarray(waveform, dtype=np.float32)
+        if waveform.ndim == 3:
+            waveform = waveform[:, 0]
+        if self.pending is None:
+            audio = waveform[:, start:]
+        else:
+            length = min(self.pending.shape[1], start)
+            keep = self.pending.shape[1] - length
+            fade = np.linspace(0.0, 1.0, length, dtype=np.float32)
+            blended = self.pending[:, keep:] * (1.0 - fade) + waveform[:, start - length : start] * fade
+            audio = np.concatenate([self.pending[:, :keep], blended, waveform[:, start:]], axis=1)
+
+        end = max(0, audio.shape[1] - self.crossfade)
+        self.pending = audio[:, end:]
+        return self._emit(audio[:, :end])
+
+    def flush(self):
+        chunk = None if self.pending is None else self._emit(self.pending)
+        self.reset()
+        return chunk
+
+    def _emit(self, chunk):
+        self.samples_out += chunk.shape[1]
+        if self.sink is not None and chunk.shape[1] > 0:
+            self.sink(chunk)
+        return chunk
@@ -0,0 +1,98 @@
+import torch
+
+# torch.compile modes: "reduce-overhead" also captures the step in a CUDA graph
+# and replays it, "default" runs the inductor kernels (C++/OpenMP on CPU)
+COMPILE_MODES = ["default", "reduce-overhead", "max-autotune"]
+
+
+def relative_error(out, reference):
+    return ((out - reference).abs().max() / reference.abs().max().clamp(min=1e-8)).item()
+
+
+class CompiledDDIMEngine:
+    """torch.compile'd DDIM step: UNet call, classifier-free guidance and update.
+
+    Set on the model by MusicLDM.set_compiled_sampling and used by
+    DDIMSampler.p_sample_ddim for plain DDIM steps. One compiled step is kept
+    per (batch, latent shape, guided) configuration on the model, so it is
+    traced once and reused by every segment and prompt. The first call of a
+    configuration is also run eagerly and compared with the compiled output; a
+    configuration whose error exceeds `tolerance` keeps running eagerly.
+    Noise is drawn outside the compiled step, so both paths use the same
+    random stream.
+    """
+
+    def __init__(self, model, mode=None, tolerance=1e-2):
+        if not hasattr(torch, "compile"):
+            raise ValueError("Compiled sampling needs torch>=2.0")
+        if mode is None:
+            mode = "reduce-overhead" if model.device.type == "cuda" else "default"
+        if mode not in COMPILE_MODES:
+            raise ValueError("Unknown compile mode %s, expected one of %s" % (mode, COMPILE_MODES))
+        self.model = model
+        self.mode = mode
+        self.tolerance = tolerance
+        self.steps = {}
+
+    def clear(self):
+        # recompile after the UNet's forward changed, e.g. a new precision policy
+        self.steps = {}
+
+    def _step(self, x, t, c, noise, scale, sqrt_at, sqrt_a_prev, sigma_t, sqrt_one_minus_at, dir_xt_coef):
+        e_t = self.model.apply_model(x, t, c)
+        return self._update(x, e_t, noise, sqrt_at, sqrt_a_prev, sigma_t, sqrt_one_minus_at, dir_xt_coef)
+
+    def _guided_step(self, x, t, c, noise, scale, sqrt_at, sqrt_a_prev, sigma_t, sqrt_one_minus_at, dir_xt_coef):
+        # c is [unconditional, conditional]
+        e_t_uncond, e_t = self.model.apply_model(torch.cat([x, x]), torch.cat([t, t]), c).chunk(2)
+        e_t = e_t_uncond + scale * (e_t - e_t_uncond)
+        return self._update(x, e_t, noise, sqrt_at, sqrt_a_prev, sigma_t, sqrt_one_minus_at, dir_xt_coef)
+
+    def _update(self, x, e_t, noise, sqrt_at, sqrt_a_prev, sigma_t, sqrt_one_minus_at, dir_xt_coef):
+        pred_x0 = (x - sqrt_one_minus_at * e_t) / sqrt_at
+        x_prev = sqrt_a_prev * pred_x0 + dir_xt_coef * e_t + sigma_t * noise
+        return x_prev, pred_x0
+
+    def _compiled_step(self, key, eager_step, args):
+        if key not in self.steps:
+            print("Compiling the DDIM step for batch %s, latent %s, guidance %s (mode %s)" % (key[0], list(key[1]), key[2], self.mode))
+            compiled = torch.compile(eager_step, mode=self.mode, dynamic=False)
+            reference = eager_step(*args)
+            out = self._run(compiled, args)
+            error = max(relative_error(o, r) for o, r in zip(out, reference))
+            if error > self.tolerance:
+                print("Compiled DDIM step differs from eager by %.2e (tolerance %.0e), running it eagerly" % (error, self.tolerance))
+                compiled = eager_step
+            else:
+                print("Compiled DDIM step matches eager, max relative error %.2e" % error)
+            self.steps[key] = compiled
+            return reference
+        return self._run(self.steps[key], args)
+
+    def _run(self, step, args):
+        if self.mode == "reduce-overhead" and hasattr(torch.compiler, "cudagraph_mark_step_begin"):
+            torch.compiler.cudagraph_mark_step_begin()
+        # graph outputs are overwritten by the next replay
+        return tuple(out.clone() for out in step(*args))
+
+    def step(self, x, t, c, noise, scale, schedule, index, guided):
+        """One DDIM step from x at timesteps t, returns (x_prev, pred_x0).
+
+        c is the conditioning passed to apply_model, doubled as
+        [unconditional, conditional] when guided. The coefficients are the
+        [1, 1, 1] views of the DDIMSchedule at index.
+        """
+        args = (
+            x,
+            t,
+            c,
+            noise,
+            scale,
+            schedule.step_sqrt_alphas[index],
+            schedule.step_sqrt_alphas_prev[index],
+            schedule.step_sigmas[index],
+            schedule.step_sqrt_one_minus_alphas[index],
+            schedule.step_dir_xt[index],
+        )
+        key = (x.shape[0], tuple(x.shape[1:]), guided)
+        return self._compiled_step(key, self._guided_step if guided else self._step, args)
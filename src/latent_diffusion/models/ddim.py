@@ -13,58 +13,62 @@ from latent_diffusion.modules.diffusionmodules.util import (
 )
 
 
-class DDIMSampler(object):
-    def __init__(self, model, schedule="linear", **kwargs):
-        super().__init__()
-        self.model = model
-        self.ddpm_num_timesteps = model.num_timesteps
-        self.schedule = schedule
-
-    def register_buffer(self, name, attr):
-        if type(attr) == torch.Tensor:
-            if attr.device != torch.device("cuda"):
-                attr = attr.to(torch.device("cuda"))
-        setattr(self, name, attr)
-
-    def make_schedule(
-        self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0.0, verbose=True
+def unique_film_embedding(diffusion_wrapper, c_film):
+    # FiLM projection of every distinct conditioning row, gathered back to the batch
+    rows, inverse = torch.unique(c_film.flatten(1), dim=0, return_inverse=True)
+    rows = rows.view(-1, *c_film.shape[1:])
+    return diffusion_wrapper.get_film_embedding(rows)[inverse]
+
+
+def select_batch(x, index):
+    # Index the batch dimension of a tensor or of the tensors in a (nested) dict/list
+    if isinstance(x, torch.Tensor):
+        return x[index]
+    if isinstance(x, dict):
+        return {k: select_batch(v, index) for k, v in x.items()}
+    if isinstance(x, list):
+        return [select_batch(v, index) for v in x]
+    return x
+
+
+class DDIMSchedule(object):
+    """Precomputed DDIM tables for one (ddim_num_steps, ddim_eta, ddim_discretize) setting.
+
+    Built once per model/device and shared by every DDIMSampler through
+    ``model.ddim_schedule_cache``. Besides the full-length tables, the per-step
+    coefficients used by ``p_sample_ddim`` are stored as [S, 1, 1, 1] device
+    tensors so a denoising step only has to index them.
+    """
+
+    def __init__(
+        self, model, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0.0, verbose=True
     ):
+        self.device = model.device
+        ddpm_num_timesteps = model.num_timesteps
         self.ddim_timesteps = make_ddim_timesteps(
             ddim_discr_method=ddim_discretize,
             num_ddim_timesteps=ddim_num_steps,
-            num_ddpm_timesteps=self.ddpm_num_timesteps,
+            num_ddpm_timesteps=ddpm_num_timesteps,
             verbose=verbose,
         )
-        alphas_cumprod = self.model.alphas_cumprod
+        alphas_cumprod = model.alphas_cumprod
         assert (
-            alphas_cumprod.shape[0] == self.ddpm_num_timesteps
+            alphas_cumprod.shape[0] == ddpm_num_timesteps
         ), "alphas have to be defined for each timestep"
-        to_torch = lambda x: x.clone().detach().to(torch.float32).to(self.model.device)
-
-        self.register_buffer("betas", to_torch(self.model.betas))
-        self.register_buffer("alphas_cumprod", to_torch(alphas_cumprod))
-        self.register_buffer(
-            "alphas_cumprod_prev", to_torch(self.model.alphas_cumprod_prev)
+        to_torch = lambda x: torch.as_tensor(x).to(
+            device=self.device, dtype=torch.float32
         )
 
+        self.betas = to_torch(model.betas)
+        self.alphas_cumprod = to_torch(alphas_cumprod)
+        self.alphas_cumprod_prev = to_torch(model.alphas_cumprod_prev)
+
         # calculations for diffusion q(x_t | x_{t-1}) and others
-        self.register_buffer(
-            "sqrt_alphas_cumprod", to_torch(np.sqrt(alphas_cumprod.cpu()))
-        )
-        self.register_buffer(
-            "sqrt_one_minus_alphas_cumprod",
-            to_torch(np.sqrt(1.0 - alphas_cumprod.cpu())),
-        )
-        self.register_buffer(
-            "log_one_minus_alphas_cumprod", to_torch(np.log(1.0 - alphas_cumprod.cpu()))
-        )
-        self.register_buffer(
-            "sqrt_recip_alphas_cumprod", to_torch(np.sqrt(1.0 / alphas_cumprod.cpu()))
-        )
-        self.register_buffer(
-            "sqrt_recipm1_alphas_cumprod",
-            to_torch(np.sqrt(1.0 / alphas_cumprod.cpu() - 1)),
-        )
+        self.sqrt_alphas_cumprod = torch.sqrt(self.alphas_cumprod)
+        self.sqrt_one_minus_alphas_cumprod = torch.sqrt(1.0 - self.alphas_cumprod)
+        self.log_one_minus_alphas_cumprod = torch.log(1.0 - self.alphas_cumprod)
+        self.sqrt_recip_alphas_cumprod = torch.sqrt(1.0 / self.alphas_cumprod)
+        self.sqrt_recipm1_alphas_cumprod = torch.sqrt(1.0 / self.alphas_cumprod - 1)
 
         # ddim sampling parameters
         ddim_sigmas, ddim_alphas, ddim_alphas_prev = make_ddim_sampling_parameters(
@@ -73,19 +77,82 @@ class DDIMSampler(object):
             eta=ddim_eta,
             verbose=verbose,
         )
-        self.register_buffer("ddim_sigmas", ddim_sigmas)
-        self.register_buffer("ddim_alphas", ddim_alphas)
-        self.register_buffer("ddim_alphas_prev", ddim_alphas_prev)
-        self.register_buffer("ddim_sqrt_one_minus_alphas", np.sqrt(1.0 - ddim_alphas))
-        sigmas_for_original_sampling_steps = ddim_eta * torch.sqrt(
+        self.ddim_sigmas = to_torch(ddim_sigmas)
+        self.ddim_alphas = to_torch(ddim_alphas)
+        self.ddim_alphas_prev = to_torch(ddim_alphas_prev)
+        self.ddim_sqrt_one_minus_alphas = torch.sqrt(1.0 - self.ddim_alphas)
+        self.ddim_sigmas_for_original_num_steps = ddim_eta * torch.sqrt(
             (1 - self.alphas_cumprod_prev)
             / (1 - self.alphas_cumprod)
             * (1 - self.alphas_cumprod / self.alphas_cumprod_prev)
         )
-        self.register_buffer(
-            "ddim_sigmas_for_original_num_steps", sigmas_for_original_sampling_steps
+
+        # per-step coefficients, indexed by the DDIM step index
+        step_shape = (-1, 1, 1, 1)
+        self.step_sqrt_alphas = self.ddim_alphas.sqrt().view(step_shape)
+        self.step_sqrt_alphas_prev = self.ddim_alphas_prev.sqrt().view(step_shape)
+        self.step_sqrt_one_minus_alphas = self.ddim_sqrt_one_minus_alphas.view(
+            step_shape
+        )
+        self.step_sigmas = self.ddim_sigmas.view(step_shape)
+        self.step_dir_xt = (
+            (1.0 - self.ddim_alphas_prev - self.ddim_sigmas**2).sqrt().view(step_shape)
         )
 
+
+class DDIMSampler(object):
+    def __init__(self, model, schedule="linear", **kwargs):
+        super().__init__()
+        self.model = model
+        self.ddpm_num_timesteps = model.num_timesteps
+        self.schedule = schedule
+        self.ddim_schedule = None
+
+    def register_buffer(self, name, attr):
+        # follow the device of the wrapped model instead of assuming cuda
+        if type(attr) == torch.Tensor:
+            if attr.device != self.model.device:
+                attr = attr.to(self.model.device)
+        setattr(self, name, attr)
+
+    def make_schedule(
+        self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0.0, verbose=True
+    ):
+        # schedules are cached on the model so they survive across segments and prompts
+        if not hasattr(self.model, "ddim_schedule_cache"):
+            self.model.ddim_schedule_cache = {}
+        cache = self.model.ddim_schedule_cache
+        key = (ddim_num_steps, float(ddim_eta), ddim_discretize)
+        schedule = cache.get(key)
+        if schedule is None or schedule.device != self.model.device:
+            schedule = DDIMSchedule(
+                self.model,
+                ddim_num_steps,
+                ddim_discretize=ddim_discretize,
+                ddim_eta=ddim_eta,
+                verbose=verbose,
+            )
+            cache[key] = schedule
+        self.ddim_schedule = schedule
+
+        for name in [
+            "ddim_timesteps",
+            "betas",
+            "alphas_cumprod",
+            "alphas_cumprod_prev",
+            "sqrt_alphas_cumprod",
+            "sqrt_one_minus_alphas_cumprod",
+            "log_one_minus_alphas_cumprod",
+            "sqrt_recip_alphas_cumprod",
+            "sqrt_recipm1_alphas_cumprod",
+            "ddim_sigmas",
+            "ddim_alphas",
+            "ddim_alphas_prev",
+            "ddim_sqrt_one_minus_alphas",
+            "ddim_sigmas_for_original_num_steps",
+        ]:
+            setattr(self, name, getattr(schedule, name))
+
     @torch.no_grad()
     def sample(
         self,
@@ -110,6 +177,8 @@ class DDIMSampler(object):
         unconditional_guidance_scale=1.0,
         unconditional_conditioning=None,
         # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
+        guidance_interval=None,
+        prune_callback=None,
         **kwargs,
     ):
         if conditioning is not None:
@@ -147,9 +216,117 @@ class DDIMSampler(object):
             log_every_t=log_every_t,
             unconditional_guidance_scale=unconditional_guidance_scale,
             unconditional_conditioning=unconditional_conditioning,
+            guidance_interval=guidance_interval,
+            prune_callback=prune_callback,
         )
         return samples, intermediates
 
+    def prepare_guidance(
+        self,
+        cond,
+        unconditional_conditioning,
+        unconditional_guidance_scale,
+        timesteps=None,
+    ):
+        """
+        Set up the per-run conditioning of one sampling run.
+        The doubled-batch x/t buffers of the fused classifier-free guidance step are
+        allocated lazily and reused across steps. For FiLM conditioning the (constant)
+        FiLM projections are computed once per distinct conditioning row instead of on
+        every step and for every candidate, and the time embeddings of all `timesteps`
+        of the run are computed up front, so a step only gathers its row. The state
+        belongs to one sampling call, a new prompt gets a new one.
+        """
+        guided = (
+            unconditional_conditioning is not None
+            and unconditional_guidance_scale != 1.0
+        )
+        diffusion_wrapper = self.model.model
+        film = diffusion_wrapper.conditioning_key == "film" and isinstance(
+            cond, torch.Tensor
+        )
+        if not guided and not film:
+            return None
+        state = {"x_in": None, "t_in": None, "guided": guided, "time_emb": None}
+        if film:
+            c_emb = unique_film_embedding(diffusion_wrapper, cond)
+            state["c"] = {"c_film_emb": [c_emb]}
+            if guided:
+                uc_emb = unique_film_embedding(
+                    diffusion_wrapper, unconditional_conditioning
+                )
+                state["c_in"] = {"c_film_emb": [torch.cat([uc_emb, c_emb])]}
+            if timesteps is not None:
+                timesteps = torch.as_tensor(
+                    np.ascontiguousarray(timesteps), device=self.model.device
+                )
+                state["time_emb"] = diffusion_wrapper.get_time_embedding(timesteps)
+        else:
+            state["c"] = cond
+            state["c_in"] = torch.cat([unconditional_conditioning, cond])
+        return state
+
+    def select_guidance(self, guidance_state, keep, b):
+        # Restrict a guidance state prepared for b samples to the samples in keep
+        if guidance_state is None:
+            return None
+        state = {
+            "x_in": None,
+            "t_in": None,
+            "guided": guidance_state["guided"],
+            "time_emb": guidance_state["time_emb"],
+            "c": select_batch(guidance_state["c"], keep),
+        }
+        if guidance_state["guided"]:
+            # c_in is [unconditional, conditional]
+            state["c_in"] = select_batch(
+                guidance_state["c_in"], torch.cat([keep, keep + b])
+            )
+        return state
+
+    def step_conditioning(self, guidance_state, index, guided, n):
+        # conditioning of one step for n model inputs, with the step's time embedding row
+        c = guidance_state["c_in"] if guided else guidance_state["c"]
+        if guidance_state["time_emb"] is None or index is None:
+            return c
+        return dict(c, time_emb=guidance_state["time_emb"][index].expand(n, -1))
+
+    def guided_model_output(
+        self,
+        x,
+        t,
+        c,
+        guidance_state,
+        unconditional_guidance_scale,
+        use_guidance=True,
+        index=None,
+    ):
+        if guidance_state is None:
+            return self.model.apply_model(x, t, c)
+        b = x.shape[0]
+        if not guidance_state["guided"] or not use_guidance:
+            # outside the guidance interval only the conditional half is evaluated
+            return self.model.apply_model(
+                x, t, self.step_conditioning(guidance_state, index, False, b)
+            )
+
+        x_in, t_in = guidance_state["x_in"], guidance_state["t_in"]
+        if x_in is None or x_in.shape[0] != 2 * b:
+            x_in = torch.empty((2 * b, *x.shape[1:]), device=x.device, dtype=x.dtype)
+            t_in = torch.empty((2 * b,), device=t.device, dtype=t.dtype)
+            guidance_state["x_in"], guidance_state["t_in"] = x_in, t_in
+        x_in[:b].copy_(x)
+        x_in[b:].copy_(x)
+        t_in[:b].copy_(t)
+        t_in[b:].copy_(t)
+        e_t_uncond, e_t = self.model.apply_model(
+            x_in, t_in, self.step_conditioning(guidance_state, index, True, 2 * b)
+        ).chunk(2)
+        # When unconditional_guidance_scale == 1: only e_t
+        # When unconditional_guidance_scale == 0: only unconditional
+        # When unconditional_guidance_scale > 1: add more unconditional guidance
+        return e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
+
     @torch.no_grad()
     def ddim_sampling(
         self,
@@ -170,6 +347,8 @@ class DDIMSampler(object):
         corrector_kwargs=None,
         unconditional_guidance_scale=1.0,
         unconditional_conditioning=None,
+        guidance_interval=None,
+        prune_callback=None,
     ):
         device = self.model.betas.device
         b = shape[0]
@@ -204,10 +383,25 @@ class DDIMSampler(object):
         print(f"Running DDIM Sampling with {total_steps} timesteps")
 
         iterator = tqdm(time_range, desc="DDIM Sampler", total=total_steps)
+        # time embeddings are looked up by the step index
+        guidance_state = self.prepare_guidance(
+            cond,
+            unconditional_conditioning,
+            unconditional_guidance_scale,
+            timesteps=np.arange(timesteps) if ddim_use_original_steps else timesteps,
+        )
+
+        feature_cache = self.model.model.diffusion_model.feature_cache
+        if feature_cache is not None:
+            if self.model.model.diffusion_model.training:
+                print("⚠️ The UNet is in training mode, the deep feature cache is not used, call .eval() on the model")
+            feature_cache.start_run()
 
         for i, step in enumerate(iterator):
             index = total_steps - i - 1
             ts = torch.full((b,), step, device=device, dtype=torch.long)
+            if feature_cache is not None:
+                feature_cache.start_step(i)
             if mask is not None:
                 assert x0 is not None
                 img_orig = self.model.q_sample(
@@ -230,6 +424,11 @@ class DDIMSampler(object):
                 corrector_kwargs=corrector_kwargs,
                 unconditional_guidance_scale=unconditional_guidance_scale,
                 unconditional_conditioning=unconditional_conditioning,
+                guidance_state=guidance_state,
+                use_guidance=guidance_interval is None
+                or guidance_interval[0]
+                <= step / self.ddpm_num_timesteps
+                <= guidance_interval[1],
             )
             img, pred_x0 = outs
             if callback:
@@ -237,10 +436,27 @@ class DDIMSampler(object):
             if img_callback:
                 img_callback(pred_x0, i)
 
+            if prune_callback is not None:
+                # prune_callback may return the indices of the samples to keep sampling
+                keep = prune_callback(i, img, pred_x0)
+                if keep is not None:
+                    img, pred_x0 = img[keep], pred_x0[keep]
+                    cond = select_batch(cond, keep)
+                    if mask is not None:
+                        mask, x0 = mask[keep], x0[keep]
+                    guidance_state = self.select_guidance(guidance_state, keep, b)
+                    b = len(keep)
+                    if feature_cache is not None:
+                        # the next step recomputes the deep features of the survivors
+                        feature_cache.clear()
+
             if index % log_every_t == 0 or index == total_steps - 1:
                 intermediates["x_inter"].append(img)
                 intermediates["pred_x0"].append(pred_x0)
 
+        if feature_cache is not None:
+            print("Deep feature cache:", feature_cache.report())
+            feature_cache.stop_run()
         return img, intermediates
 
     @torch.no_grad()
@@ -286,6 +502,12 @@ class DDIMSampler(object):
 
         iterator = tqdm(time_range, desc="Decoding image", total=total_steps)
         x_dec = x_latent
+        guidance_state = self.prepare_guidance(
+            cond,
+            unconditional_conditioning,
+            unconditional_guidance_scale,
+            timesteps=timesteps,
+        )
 
         for i, step in enumerate(iterator):
             index = total_steps - i - 1
@@ -300,6 +522,7 @@ class DDIMSampler(object):
                 use_original_steps=use_original_steps,
                 unconditional_guidance_scale=unconditional_guidance_scale,
                 unconditional_conditioning=unconditional_conditioning,
+                guidance_state=guidance_state,
             )
         return x_dec
 
@@ -319,20 +542,54 @@ class DDIMSampler(object):
         corrector_kwargs=None,
         unconditional_guidance_scale=1.0,
         unconditional_conditioning=None,
+        guidance_state=None,
+        use_guidance=True,
     ):
         b, *_, device = *x.shape, x.device
 
-        if unconditional_conditioning is None or unconditional_guidance_scale == 1.0:
-            e_t = self.model.apply_model(x, t, c)
-        else:
-            x_in = torch.cat([x] * 2)
-            t_in = torch.cat([t] * 2)
-            c_in = torch.cat([unconditional_conditioning, c])
-            e_t_uncond, e_t = self.model.apply_model(x_in, t_in, c_in).chunk(2)
-            # When unconditional_guidance_scale == 1: only e_t
-            # When unconditional_guidance_scale == 0: only unconditional
-            # When unconditional_guidance_scale > 1: add more unconditional guidance
-            e_t = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
+        if guidance_state is None:
+            # stand-alone call (e.g. from decode), set up the guidance for this step only
+            guidance_state = self.prepare_guidance(
+                c, unconditional_conditioning, unconditional_guidance_scale
+            )
+
+        engine = getattr(self.model, "compiled_ddim", None)
+        if (
+            engine is not None
+            and not use_original_steps
+            and not quantize_denoised
+            and score_corrector is None
+            and noise_dropout == 0.0
+        ):
+            # the same step through the compiled engine, see MusicLDM.set_compiled_sampling
+            if guidance_state is None:
+                c_step, guided = c, False
+            else:
+                guided = guidance_state["guided"] and use_guidance
+                c_step = self.step_conditioning(
+                    guidance_state, index, guided, 2 * b if guided else b
+                )
+            noise = noise_like(x.shape, device, repeat_noise) * temperature
+            return engine.step(
+                x,
+                t,
+                c_step,
+                noise,
+                unconditional_guidance_scale,
+                self.ddim_schedule,
+                index,
+                guided,
+            )
+
+        e_t = self.guided_model_output(
+            x,
+            t,
+            c,
+            guidance_state,
+            unconditional_guidance_scale,
+            use_guidance=use_guidance,
+            index=index,
+        )
 
         if score_corrector is not None:
             assert self.model.parameterization == "eps"
@@ -340,38 +597,37 @@ class DDIMSampler(object):
                 self.model, e_t, x, t, c, **corrector_kwargs
             )
 
-        alphas = self.model.alphas_cumprod if use_original_steps else self.ddim_alphas
-        alphas_prev = (
-            self.model.alphas_cumprod_prev
-            if use_original_steps
-            else self.ddim_alphas_prev
-        )
-        sqrt_one_minus_alphas = (
-            self.model.sqrt_one_minus_alphas_cumprod
-            if use_original_steps
-            else self.ddim_sqrt_one_minus_alphas
-        )
-        sigmas = (
-            self.model.ddim_sigmas_for_original_num_steps
-            if use_original_steps
-            else self.ddim_sigmas
-        )
         # select parameters corresponding to the currently considered timestep
-        a_t = torch.full((b, 1, 1, 1), alphas[index], device=device)
-        a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
-        sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
-        sqrt_one_minus_at = torch.full(
-            (b, 1, 1, 1), sqrt_one_minus_alphas[index], device=device
-        )
+        if use_original_steps:
+            alphas = self.model.alphas_cumprod
+            alphas_prev = self.model.alphas_cumprod_prev
+            sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod
+            sigmas = self.ddim_sigmas_for_original_num_steps
+            sqrt_at = torch.full((b, 1, 1, 1), alphas[index], device=device).sqrt()
+            a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
+            sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
+            sqrt_one_minus_at = torch.full(
+                (b, 1, 1, 1), sqrt_one_minus_alphas[index], device=device
+            )
+            sqrt_a_prev = a_prev.sqrt()
+            dir_xt_coef = (1.0 - a_prev - sigma_t**2).sqrt()
+        else:
+            # precomputed [1, 1, 1] views, broadcast over the batch
+            schedule = self.ddim_schedule
+            sqrt_at = schedule.step_sqrt_alphas[index]
+            sqrt_a_prev = schedule.step_sqrt_alphas_prev[index]
+            sigma_t = schedule.step_sigmas[index]
+            sqrt_one_minus_at = schedule.step_sqrt_one_minus_alphas[index]
+            dir_xt_coef = schedule.step_dir_xt[index]
 
         # current prediction for x_0
-        pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
+        pred_x0 = (x - sqrt_one_minus_at * e_t) / sqrt_at
         if quantize_denoised:
             pred_x0, _, *_ = self.model.first_stage_model.quantize(pred_x0)
         # direction pointing to x_t
-        dir_xt = (1.0 - a_prev - sigma_t**2).sqrt() * e_t
+        dir_xt = dir_xt_coef * e_t
         noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
         if noise_dropout > 0.0:
             noise = torch.nn.functional.dropout(noise, p=noise_dropout)
-        x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise  # TODO
+        x_prev = sqrt_a_prev * pred_x0 + dir_xt + noise  # TODO
         return x_prev, pred_x0
@@ -0,0 +1,64 @@
+class DeepFeatureCache:
+    """Reuse the deep UNet features across DDIM steps (DeepCache).
+
+    Set on the UNet by MusicLDM.set_deep_cache and stepped by
+    DDIMSampler.ddim_sampling. Every `interval` steps the full UNet runs and
+    the decoder feature entering the last `depth` output blocks, which
+    summarizes the deeper input blocks, the middle block and the deeper output
+    blocks, is cached. The steps in between only run the first `depth` input
+    blocks and the last `depth` output blocks on top of the cached feature.
+    A step whose batch differs from the cached one (pruning, the guidance
+    interval) runs in full. This is an approximation, see validate_deep_cache.py.
+    """
+
+    def __init__(self, interval, depth=3):
+        if interval < 1:
+            raise ValueError("The refresh interval must be at least 1, got %s" % interval)
+        if depth < 1:
+            raise ValueError("The number of shallow blocks must be at least 1, got %s" % depth)
+        self.interval = interval
+        self.depth = depth
+        self.active = False
+        self.clear()
+
+    def clear(self):
+        self.h = None
+        self.refresh = True
+
+    def start_run(self):
+        self.clear()
+        self.active = True
+        self.full_steps = 0
+        self.cached_steps = 0
+
+    def stop_run(self):
+        # outside a DDIM run (other samplers, training) the UNet always runs in full
+        self.clear()
+        self.active = False
+
+    def start_step(self, i):
+        self.refresh = i % self.interval == 0
+
+    def reuse(self, x):
+        return (
+            self.active
+            and not self.refresh
+            and self.h is not None
+            and self.h.shape[0] == x.shape[0]
+        )
+
+    def store(self, h):
+        if self.active:
+            self.h = h
+            self.full_steps += 1
+
+    def report(self):
+        return {
+            "interval": self.interval,
+            "depth": self.depth,
+            "full_unet_steps": self.full_steps,
+            "cached_unet_steps": self.cached_steps,
+        }
+
+    def __str__(self):
+        return "refresh every %s steps, %s shallow blocks" % (self.interval, self.depth)
@@ -410,6 +410,7 @@ class DPM_Solver:
         predict_x0=False,
         thresholding=False,
         max_val=1.0,
+        correcting_xt_fn=None,
     ):
         """Construct a DPM-Solver.
 
@@ -429,6 +430,8 @@ class DPM_Solver:
             predict_x0: A `bool`. If true, use the data prediction model; else, use the noise prediction model.
             thresholding: A `bool`. Valid when `predict_x0` is True. Whether to use the "dynamic thresholding" in [1].
             max_val: A `float`. Valid when both `predict_x0` and `thresholding` are True. The max value for thresholding.
+            correcting_xt_fn: A function `correcting_xt_fn(x, t) -> x` applied to the intermediate `x` before every model
+                evaluation of the multistep solver, e.g. to paste the known region back in for inpainting.
 
         [1] Chitwan Saharia, William Chan, Saurabh Saxena, Lala Li, Jay Whang, Emily Denton, Seyed Kamyar Seyed Ghasemipour, Burcu Karagol Ayan, S Sara Mahdavi, Rapha Gontijo Lopes, et al. Photorealistic text-to-image diffusion models with deep language understanding. arXiv preprint arXiv:2205.11487, 2022b.
         """
@@ -437,6 +440,7 @@ class DPM_Solver:
         self.predict_x0 = predict_x0
         self.thresholding = thresholding
         self.max_val = max_val
+        self.correcting_xt_fn = correcting_xt_fn
 
     def noise_prediction_fn(self, x, t):
         """
@@ -1361,6 +1365,8 @@ class DPM_Solver:
             assert timesteps.shape[0] - 1 == steps
             with torch.no_grad():
                 vec_t = timesteps[0].expand((x.shape[0]))
+                if self.correcting_xt_fn is not None:
+                    x = self.correcting_xt_fn(x, vec_t)
                 model_prev_list = [self.model_fn(x, vec_t)]
                 t_prev_list = [vec_t]
                 # Init the first `order` values by lower order multistep DPM-Solver.
@@ -1374,6 +1380,8 @@ class DPM_Solver:
                         init_order,
                         solver_type=solver_type,
                     )
+                    if self.correcting_xt_fn is not None:
+                        x = self.correcting_xt_fn(x, vec_t)
                     model_prev_list.append(self.model_fn(x, vec_t))
                     t_prev_list.append(vec_t)
                 # Compute the remaining values by `order`-th order multistep DPM-Solver.
@@ -1397,6 +1405,8 @@ class DPM_Solver:
                     t_prev_list[-1] = vec_t
                     # We do not need to evaluate the final model value.
                     if step < steps:
+                        if self.correcting_xt_fn is not None:
+                            x = self.correcting_xt_fn(x, vec_t)
                         model_prev_list[-1] = self.model_fn(x, vec_t)
         elif method in ["singlestep", "singlestep_fixed"]:
             if method == "singlestep":
@@ -2,7 +2,7 @@
 
 import torch
 
-from .dpm_solver import NoiseScheduleVP, model_wrapper, DPM_Solver
+from .dpm_solver import NoiseScheduleVP, model_wrapper, DPM_Solver, expand_dims
 
 
 class DPMSolverSampler(object):
@@ -14,8 +14,8 @@ class DPMSolverSampler(object):
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
-            if attr.device != torch.device("cuda"):
-                attr = attr.to(torch.device("cuda"))
+            if attr.device != self.model.device:
+                attr = attr.to(self.model.device)
         setattr(self, name, attr)
 
     @torch.no_grad()
@@ -42,6 +42,9 @@ class DPMSolverSampler(object):
         unconditional_guidance_scale=1.0,
         unconditional_conditioning=None,
         # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
+        order=2,
+        method="multistep",
+        skip_type="time_uniform",
         **kwargs,
     ):
         if conditioning is not None:
@@ -61,7 +64,7 @@ class DPMSolverSampler(object):
         C, H, W = shape
         size = (batch_size, C, H, W)
 
-        # print(f'Data shape for DPM-Solver sampling is {size}, sampling steps {S}')
+        print(f"Data shape for DPM-Solver++ sampling is {size}, sampling steps {S}, order {order}")
 
         device = self.model.betas.device
         if x_T is None:
@@ -71,6 +74,19 @@ class DPMSolverSampler(object):
 
         ns = NoiseScheduleVP("discrete", alphas_cumprod=self.alphas_cumprod)
 
+        correcting_xt_fn = None
+        if mask is not None:
+            assert x0 is not None
+            assert method == "multistep", "Inpainting is only supported by the multistep solver"
+
+            def correcting_xt_fn(x, t):
+                # same as the DDIM path: keep the (noised) known region where mask == 1
+                dims = x.dim()
+                alpha_t = expand_dims(ns.marginal_alpha(t), dims)
+                sigma_t = expand_dims(ns.marginal_std(t), dims)
+                x_orig = alpha_t * x0 + sigma_t * torch.randn_like(x0)
+                return x_orig * mask + (1.0 - mask) * x
+
         model_fn = model_wrapper(
             lambda x, t, c: self.model.apply_model(x, t, c),
             ns,
@@ -81,13 +97,19 @@ class DPMSolverSampler(object):
             guidance_scale=unconditional_guidance_scale,
         )
 
-        dpm_solver = DPM_Solver(model_fn, ns, predict_x0=True, thresholding=False)
+        dpm_solver = DPM_Solver(
+            model_fn,
+            ns,
+            predict_x0=True,
+            thresholding=False,
+            correcting_xt_fn=correcting_xt_fn,
+        )
         x = dpm_solver.sample(
             img,
             steps=S,
-            skip_type="time_uniform",
-            method="multistep",
-            order=2,
+            skip_type=skip_type,
+            method=method,
+            order=order,
             lower_order_final=True,
         )
 
@@ -0,0 +1,257 @@
+import copy
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from itertools import chain
+
+import torch
+
+from latent_diffusion.models.musicldm import MusicLDM
+
+try:
+    from safetensors.torch import load_file, save_file
+except ImportError:
+    load_file, save_file = None, None
+
+# weights of submodules that are only used for training
+TRAINING_ONLY_PREFIXES = ["first_stage_model.loss."]
+# submodules left out of the bundle: the EMA copy is baked into the UNet and,
+# unless converted with keep_encoder=True, the VAE encoder as text-to-music
+# never encodes audio
+BUNDLE_ENCODER_MODULES = ["first_stage_model.encoder", "first_stage_model.quant_conv"]
+BUNDLE_SKIPPED_MODULES = ["model_ema"] + BUNDLE_ENCODER_MODULES
+# tokenizer and text model config files are stored as uint8 tensors under this prefix
+BUNDLE_FILE_PREFIX = "files/"
+
+
+_register_parameter = torch.nn.Module.register_parameter
+_apply = torch.nn.Module._apply
+# empty_weights() is scoped to the thread that entered it, other threads building
+# modules at the same time get the original behaviour
+_empty_weights_local = threading.local()
+_empty_weights_lock = threading.Lock()
+_empty_weights_users = [0]
+
+
+class MissingModule(torch.nn.Module):
+    # stands in for a submodule left out of the bundle
+    def __init__(self, message):
+        super().__init__()
+        self.message = message
+
+    def forward(self, *args, **kwargs):
+        raise RuntimeError(self.message)
+
+
+def _building_empty():
+    return getattr(_empty_weights_local, "depth", 0) > 0
+
+
+def _register_empty_parameter(module, name, param):
+    _register_parameter(module, name, param)
+    if _building_empty() and param is not None and not param.is_meta:
+        param = module._parameters[name]
+        module._parameters[name] = type(param)(param.to("meta"), requires_grad=param.requires_grad)
+
+
+def _apply_skipping_meta(module, fn, *args, **kwargs):
+    if not _building_empty():
+        return _apply(module, fn, *args, **kwargs)
+    return _apply(module, lambda t: t if t.is_meta else fn(t), *args, **kwargs)
+
+
+@contextmanager
+def empty_weights():
+    """Build modules without allocating or initializing their parameters.
+
+    Parameters are moved to the meta device as soon as they are registered, so
+    the random initializations run on meta tensors and cost nothing. Buffers
+    are still created normally as some are computed in __init__ (noise
+    schedule, position ids). Module.to() and friends skip meta tensors, as
+    some constructors move their submodules to the CPU. Only modules built by
+    the calling thread are affected.
+    """
+    with _empty_weights_lock:
+        if _empty_weights_users[0] == 0:
+            torch.nn.Module.register_parameter = _register_empty_parameter
+            torch.nn.Module._apply = _apply_skipping_meta
+        _empty_weights_users[0] += 1
+    _empty_weights_local.depth = getattr(_empty_weights_local, "depth", 0) + 1
+    try:
+        yield
+    finally:
+        _empty_weights_local.depth -= 1
+        with _empty_weights_lock:
+            _empty_weights_users[0] -= 1
+            if _empty_weights_users[0] == 0:
+                torch.nn.Module.register_parameter = _register_parameter
+                torch.nn.Module._apply = _apply
+
+
+def inference_params(model_config):
+    # MusicLDM params without the training loss and without any checkpoint loading in __init__
+    params = copy.deepcopy(model_config["params"])
+    params.pop("ckpt_path", None)
+    first_stage_params = params["first_stage_config"]["params"]
+    first_stage_params["lossconfig"] = None
+    first_stage_params["ddconfig"].pop("hifigan_ckpt", None)
+    params["cond_stage_config"]["params"]["pretrained_path"] = ""
+    return params
+
+
+def save_weights(state_dict, path):
+    if path.endswith(".safetensors"):
+        if save_file is None:
+            raise ImportError("safetensors is required to write %s" % path)
+        save_file(state_dict, path)
+    else:
+        torch.save(state_dict, path)
+
+
+def load_weights(path, device="cpu"):
+    # torch files are memory-mapped, safetensors load_file reads every tensor into memory
+    if path.endswith(".safetensors"):
+        if load_file is None:
+            raise ImportError("safetensors is required to read %s" % path)
+        return load_file(path, device=str(device))
+    return torch.load(path, map_location=device, mmap=True, weights_only=True)
+
+
+def load_bundle(path, device="cpu", dtype=torch.float32):
+    # weights and bundled files of an inference bundle, float16 weights are cast to dtype
+    state_dict = load_weights(path, device)
+    files = {}
+    for name in list(state_dict):
+        if name.startswith(BUNDLE_FILE_PREFIX):
+            files[name[len(BUNDLE_FILE_PREFIX) :]] = state_dict.pop(name).cpu().numpy().tobytes()
+        elif dtype is not None and state_dict[name].dtype == torch.float16:
+            state_dict[name] = state_dict[name].to(dtype)
+    return state_dict, files
+
+
+def convert_checkpoint(config, path, fp16=False, keep_encoder=False):
+    """Build MusicLDM the standard way and save an inference bundle to a single file.
+
+    The bundle holds the final state of every submodule used for text-to-music:
+    the UNet with its EMA weights, the VAE decoder, the vocoder after weight
+    norm removal and both CLAP towers, plus the RoBERTa tokenizer and config
+    files so that loading needs no network access. With fp16=True parameters
+    are stored in half precision, buffers (noise schedule) keep their dtype.
+    The VAE encoder is left out unless keep_encoder=True.
+    """
+    model = MusicLDM(**config["model"]["params"])
+    model.bake_ema()
+    parameters = set(name for name, _ in model.named_parameters())
+    skipped_modules = ["model_ema"] if keep_encoder else BUNDLE_SKIPPED_MODULES
+    skipped = TRAINING_ONLY_PREFIXES + [prefix + "." for prefix in skipped_modules]
+
+    state_dict = {}
+    storages = set()
+    for name, tensor in model.state_dict().items():
+        if any(name.startswith(prefix) for prefix in skipped):
+            continue
+        tensor = tensor.detach().cpu()
+        if fp16 and name in parameters and tensor.is_floating_point():
+            tensor = tensor.half()
+        # safetensors does not store tensors sharing memory
+        if tensor.untyped_storage().data_ptr() in storages:
+            tensor = tensor.clone()
+        storages.add(tensor.untyped_storage().data_ptr())
+        state_dict[name] = tensor.contiguous()
+
+    clap = model.cond_stage_model
+    with tempfile.TemporaryDirectory() as text_model_path:
+        clap.tokenize.save_pretrained(text_model_path)
+        clap.model.text_branch.config.save_pretrained(text_model_path)
+        for filename in sorted(os.listdir(text_model_path)):
+            with open(os.path.join(text_model_path, filename), "rb") as f:
+                state_dict[BUNDLE_FILE_PREFIX + filename] = torch.frombuffer(bytearray(f.read()), dtype=torch.uint8)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    save_weights(state_dict, path)
+    print("Saved %s tensors to %s" % (len(state_dict), path))
+    return path
+
+
+def build_inference_model(config, weights_path, device="cuda:0"):
+    """Inference-only MusicLDM, built without its training loss and loaded from one bundle.
+
+    Modules are built with empty parameters and the weights are loaded from
+    the file onto the target device and assigned without a copy, instead of
+    being randomly initialized, loaded on the CPU from several checkpoints and
+    then moved. On the CPU, float32 weights of a torch file (.pt) stay backed
+    by the file, a .safetensors file is read into memory once.
+    """
+    device = torch.device(device)
+    state_dict, files = load_bundle(weights_path, device)
+    params = inference_params(config["model"])
+    # files converted before the EMA was baked in still hold the LitEma buffers
+    params["use_ema"] = any(name.startswith("model_ema.") for name in state_dict)
+
+    with tempfile.TemporaryDirectory() as text_model_path:
+        if files:
+            for filename, data in files.items():
+                with open(os.path.join(text_model_path, filename), "wb") as f:
+                    f.write(data)
+            params["cond_stage_config"]["params"]["text_model_path"] = text_model_path
+        with empty_weights():
+            model = MusicLDM(**params)
+
+    for name in BUNDLE_SKIPPED_MODULES:
+        parent, _, child = name.rpartition(".")
+        if getattr(model.get_submodule(parent), child, None) is not None and not any(
+            key.startswith(name + ".") for key in state_dict
+        ):
+            if name in BUNDLE_ENCODER_MODULES:
+                missing_module = MissingModule(
+                    "The VAE encoder is not included in %s, convert the checkpoint with --keep_encoder "
+                    "to encode audio" % weights_path
+                )
+            else:
+                missing_module = None
+            setattr(model.get_submodule(parent), child, missing_module)
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    missing = [
+        name
+        for name, tensor in chain(model.named_parameters(), model.named_buffers())
+        if tensor.is_meta
+    ]
+    if missing:
+        raise RuntimeError("%s is missing weights for %s" % (weights_path, ", ".join(missing[:10])))
+    model.bake_ema()
+    return model.to(device).eval()
+
+
+def benchmark_startup(config, weights_path, device="cuda:0"):
+    # Time to a model ready on the device, today's path against the inference-only one
+    device = torch.device(device)
+    timings = {}
+    for label in ["checkpoints", "bundle"]:
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        start = time.time()
+        if label == "checkpoints":
+            model = MusicLDM(**config["model"]["params"])
+            model.bake_ema()
+            model.to(device)
+        else:
+            model = build_inference_model(config, weights_path, device)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        timings[label] = time.time() - start
+        del model
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+    print(
+        "Startup on %s: %.2f s from the checkpoints, %.2f s from %s (%.1fx)"
+        % (
+            device,
+            timings["checkpoints"],
+            timings["bundle"],
+            weights_path,
+            timings["checkpoints"] / max(timings["bundle"], 1e-6),
+        )
+    )
+    return timings
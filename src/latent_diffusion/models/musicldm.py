@@ -37,6 +37,9 @@ from latent_diffusion.util import (
     instantiate_from_config,
 )
 from latent_diffusion.modules.ema import LitEma
+from latent_diffusion.modules.precision import PrecisionPolicy, autocast_method
+from latent_diffusion.modules.alignment import find_best_waveform_alignment
+from utilities.audio.writer import IncrementalAudioWriter
 from latent_diffusion.modules.distributions.distributions import (
     normal_kl,
     DiagonalGaussianDistribution,
@@ -52,7 +55,10 @@ from latent_diffusion.modules.diffusionmodules.util import (
     noise_like,
 )
 from latent_diffusion.models.ddim import DDIMSampler
+from latent_diffusion.models.compiled_ddim import CompiledDDIMEngine
+from latent_diffusion.models.deep_cache import DeepFeatureCache
 from latent_diffusion.models.plms import PLMSSampler
+from latent_diffusion.models.dpm_solver import DPMSolverSampler
 import soundfile as sf
 import os
 
@@ -311,6 +317,19 @@ class DDPM(pl.LightningModule):
                 if context is not None:
                     print(f"{context}: Restored training weights")
 
+    def bake_ema(self):
+        """Copy the EMA weights into the model for good and drop the LitEma buffers.
+
+        Inference only: ema_scope then no longer stores, swaps and restores the
+        weights on every generation, and the extra copy of the UNet is freed.
+        """
+        if not self.use_ema:
+            return
+        self.model_ema.copy_to(self.model)
+        del self.model_ema
+        self.use_ema = False
+        print("Baked the EMA weights into the model")
+
     def init_from_ckpt(self, path, ignore_keys=list(), only_model=False):
         sd = torch.load(path, map_location="cpu")
         if "state_dict" in list(sd.keys()):
@@ -811,6 +830,42 @@ class MusicLDM(DDPM):
         if ckpt_path is not None:
             self.init_from_ckpt(ckpt_path, ignore_keys)
             self.restarted_from_ckpt = True
+        self.precision_policy = PrecisionPolicy()
+        self.compiled_ddim = None
+
+    def set_precision_policy(self, policy):
+        # Inference only: run the UNet, VAE decoder, vocoder and CLAP under autocast in the policy's dtypes
+        policy.check_device(self.device)
+        self.precision_policy = policy
+        autocast_method(self.model.diffusion_model, "forward", policy.dtype("unet"))
+        autocast_method(self.first_stage_model, "decode", policy.dtype("vae"))
+        autocast_method(self.first_stage_model.vocoder, "forward", policy.dtype("vocoder"))
+        if self.cond_stage_model is not None:
+            self.cond_stage_model.compute_dtype = policy.dtype("clap")
+        print("Precision policy: %s" % policy)
+        if self.compiled_ddim is not None:
+            self.compiled_ddim.clear()
+
+    def set_compiled_sampling(self, enabled=True, mode=None):
+        # Inference only: run the DDIM steps through torch.compile, mode None picks CUDA graphs on CUDA
+        if enabled and self.model.diffusion_model.feature_cache is not None:
+            raise ValueError("Compiled sampling cannot be combined with the deep feature cache")
+        self.compiled_ddim = CompiledDDIMEngine(self, mode=mode) if enabled else None
+        if enabled:
+            print("Compiled DDIM sampling: %s" % self.compiled_ddim.mode)
+
+    def set_deep_cache(self, interval=None, depth=3):
+        # Inference only: reuse the deep UNet features for interval - 1 of every interval DDIM steps, None disables
+        unet = self.model.diffusion_model
+        if interval is None:
+            unet.feature_cache = None
+            return
+        if self.compiled_ddim is not None:
+            raise ValueError("The deep feature cache cannot be combined with compiled sampling")
+        if depth >= len(unet.input_blocks):
+            raise ValueError("The UNet has %s input blocks, use fewer than that as shallow blocks" % len(unet.input_blocks))
+        unet.feature_cache = DeepFeatureCache(interval, depth)
+        print("Deep feature cache: %s" % unet.feature_cache)
 
     def configure_optimizers(self):
         lr = self.learning_rate
@@ -886,6 +941,8 @@ class MusicLDM(DDPM):
         super().register_schedule(
             given_betas, beta_schedule, timesteps, linear_start, linear_end, cosine_s
         )
+        # DDIM schedules derived from the old betas are no longer valid
+        self.ddim_schedule_cache = {}
 
         self.shorten_cond_schedule = self.num_timesteps_cond > 1
         if self.shorten_cond_schedule:
@@ -932,6 +989,10 @@ class MusicLDM(DDPM):
             )
         return self.scale_factor * z
 
+    def get_latent_shape(self, batch_size):
+        # Shape of one generated latent segment, known without running the VAE encoder
+        return (batch_size, self.channels, self.latent_t_size, self.latent_f_size)
+
     def get_learned_conditioning(self, c):
         if self.cond_stage_forward is None:
             if hasattr(self.cond_stage_model, "encode") and callable(
@@ -1271,6 +1332,54 @@ class MusicLDM(DDPM):
             else:
                 return self.first_stage_model.decode(z)
 
+    @torch.no_grad()
+    def decode_first_stage_partial(self, z, start, context_frames=32):
+        # Decode only the latent frames z[:, :, start:], e.g. the newly generated half of a
+        # continuation. context_frames latent frames before start are decoded along with them
+        # so the decoder's convolutions see the same neighbourhood as in a full decode. The
+        # mid-block attention and group norms still see a shorter input, so the result is close
+        # to, not equal to, a full decode (see check_partial_decode).
+        # Returns the mel including the context and the number of leading context mel frames,
+        # which the caller drops after vocoding.
+        context_start = max(0, start - context_frames)
+        mel = self.decode_first_stage(z[:, :, context_start:, :])
+        n_context = (start - context_start) * mel.size(2) // (z.size(2) - context_start)
+        return mel, n_context
+
+    @torch.no_grad()
+    def check_partial_decode(self, z, start, context_frames=32, mel_tolerance=None, min_snr_db=None):
+        # Compare decode_first_stage_partial with a full decode of z on the retained frames.
+        # Raises if the mel error is above mel_tolerance or the waveform SNR below min_snr_db.
+        mel_full = self.decode_first_stage(z)
+        mel_part, n_context = self.decode_first_stage_partial(z, start, context_frames)
+        n_new = mel_part.size(2) - n_context
+        waveform_full = self.first_stage_model.vocoder(mel_full.squeeze(1).permute(0, 2, 1))
+        waveform_part = self.first_stage_model.vocoder(mel_part.squeeze(1).permute(0, 2, 1))
+        hop = waveform_part.size(-1) // mel_part.size(2)
+        # the audio that full-segment decoding would keep
+        waveform_full = waveform_full[..., -n_new * hop :]
+        waveform_part = waveform_part[..., n_context * hop :]
+        mel_full = mel_full[:, :, -n_new:, :]
+        error = waveform_part - waveform_full
+        result = {
+            "mel_max_abs_error": (mel_part[:, :, n_context:, :] - mel_full).abs().max().item(),
+            "waveform_max_abs_error": error.abs().max().item(),
+            "waveform_snr_db": (
+                10 * torch.log10(waveform_full.pow(2).sum() / error.pow(2).sum().clamp(min=1e-12))
+            ).item(),
+        }
+        if mel_tolerance is not None and result["mel_max_abs_error"] > mel_tolerance:
+            raise RuntimeError(
+                "Partial decode differs from the full decode by %.4f in log-mel, tolerance %s"
+                % (result["mel_max_abs_error"], mel_tolerance)
+            )
+        if min_snr_db is not None and result["waveform_snr_db"] < min_snr_db:
+            raise RuntimeError(
+                "Partial decode waveform SNR %.1f dB is below %s dB"
+                % (result["waveform_snr_db"], min_snr_db)
+            )
+        return result
+
     # same as above but without decorator
     def differentiable_decode_first_stage(
         self, z, predict_cids=False, force_not_quantize=False
@@ -1864,6 +1973,8 @@ class MusicLDM(DDPM):
         unconditional_conditioning=None,
         use_plms=False,
         mask=None,
+        use_dpm_solver=False,
+        dpm_solver_order=2,
         **kwargs,
     ):
 
@@ -1873,7 +1984,23 @@ class MusicLDM(DDPM):
             shape = (self.channels, self.latent_t_size, self.latent_f_size)
 
         intermediate = None
-        if ddim and not use_plms:
+        if use_dpm_solver:
+            print("Use DPM-Solver++ sampler")
+            # DPM-Solver++ (multistep, data prediction); ddim_steps is the number of function evaluations
+            dpm_solver_sampler = DPMSolverSampler(self)
+            samples, intermediates = dpm_solver_sampler.sample(
+                ddim_steps,
+                batch_size,
+                shape,
+                cond,
+                verbose=False,
+                unconditional_guidance_scale=unconditional_guidance_scale,
+                unconditional_conditioning=unconditional_conditioning,
+                mask=mask,
+                order=dpm_solver_order,
+                **kwargs,
+            )
+        elif ddim and not use_plms:
             print("Use ddim sampler")
 
             ddim_sampler = DDIMSampler(self)
@@ -1943,26 +2070,6 @@ class MusicLDM(DDPM):
         if use_plms:
             assert ddim_steps is not None
 
-        def find_best_waveform_alignment(waveform1, waveform2, margin=1000):
-            # [2, 1, 163872]
-            diff = 32768
-            best_offset = None
-            for i in range(2, margin):
-                waveform_distance = np.mean(
-                    np.abs(waveform1[..., i:] - waveform2[..., :-i])
-                )
-                if waveform_distance < diff:
-                    best_offset = i
-                    diff = waveform_distance
-            for i in range(2, margin):
-                waveform_distance = np.mean(
-                    np.abs(waveform2[..., i:] - waveform1[..., :-i])
-                )
-                if waveform_distance < diff:
-                    best_offset = -i
-                    diff = waveform_distance
-            return best_offset
-
         use_ddim = ddim_steps is not None
         waveform_save_path = os.path.join(self.get_log_dir(), name)
         os.makedirs(waveform_save_path, exist_ok=True)
@@ -1970,9 +2077,11 @@ class MusicLDM(DDPM):
 
         with self.ema_scope("Plotting"):
             for batch in batchs:
-                z, c = self.get_input(
+                # Text-to-music: the dummy fbank does not need to go through the VAE encoder
+                _, c = self.get_input(
                     batch,
                     self.first_stage_key,
+                    return_first_stage_encode=False,
                     return_first_stage_outputs=False,
                     force_c_encode=True,
                     return_original_cond=False,
@@ -1981,7 +2090,7 @@ class MusicLDM(DDPM):
                 text = super().get_input(batch, "text")
 
                 # Generate multiple samples
-                batch_size = z.shape[0]
+                batch_size = len(text)
                 c = torch.cat([c], dim=0)
 
                 if unconditional_guidance_scale != 1.0:
@@ -1994,6 +2103,24 @@ class MusicLDM(DDPM):
                 waveform = None
                 waveform_segment_length = None
                 mel_segment_length = None
+                # Only the tail that the next stitch may trim is kept in memory,
+                # everything before it is appended to one file per sample
+                writers = [
+                    IncrementalAudioWriter(
+                        os.path.join(
+                            waveform_save_path,
+                            "%s.wav"
+                            % (
+                                os.path.basename(fname)
+                                if (not ".wav" in fname)
+                                else os.path.basename(fname).split(".")[0]
+                            ),
+                        ),
+                        samplerate=16000,
+                    )
+                    for fname in fnames
+                ]
+                stitch_margin = 1000
 
                 while True:
                     if waveform is None:
@@ -2023,6 +2150,7 @@ class MusicLDM(DDPM):
                         )
                         mel_segment_length = mel.size(-2)
                         waveform_segment_length = waveform.shape[-1]
+                        hold_length = waveform_segment_length // 4 + 2 * stitch_margin
                     else:
                         _, h, w = samples.shape[0], samples.shape[2], samples.shape[3]
 
@@ -2062,8 +2190,11 @@ class MusicLDM(DDPM):
                             ..., -(waveform_segment_length // 4) :
                         ]
                         offset = find_best_waveform_alignment(
-                            margin_waveform,
-                            waveform_continuation[..., : margin_waveform.shape[-1]],
+                            torch.from_numpy(margin_waveform).to(self.device),
+                            torch.from_numpy(
+                                waveform_continuation[..., : margin_waveform.shape[-1]]
+                            ).to(self.device),
+                            margin=stitch_margin,
                         )
                         print("Concatenation offset is %s" % offset)
                         waveform = np.concatenate(
@@ -2075,10 +2206,17 @@ class MusicLDM(DDPM):
                             ],
                             axis=-1,
                         )
-                        self.save_waveform(waveform, waveform_save_path, name=fnames)
-                        if waveform.shape[-1] / 16000 > generate_duration:
+                        if (writers[0].frames + waveform.shape[-1]) / 16000 > generate_duration:
+                            for i, writer in enumerate(writers):
+                                writer.write(waveform[i, 0])
+                                writer.close()
                             break
 
+                    for i, writer in enumerate(writers):
+                        writer.write(waveform[i, 0, :-hold_length])
+                        writer.flush()
+                    waveform = waveform[..., -hold_length:]
+
         return waveform_save_path
 
     @torch.no_grad()
@@ -2120,18 +2258,21 @@ class MusicLDM(DDPM):
 
         with self.ema_scope("Plotting"):
             for batch in batchs:
-                z, c = self.get_input(
+                # Text-to-music: the dummy fbank does not need to go through the VAE encoder
+                _, c = self.get_input(
                     batch,
                     self.first_stage_key,
+                    return_first_stage_encode=False,
                     return_first_stage_outputs=False,
                     force_c_encode=True,
                     return_original_cond=False,
                     bs=None,
                 )
                 text = super().get_input(batch, "text")
+                z_shape = self.get_latent_shape(len(text))
 
                 # Generate multiple samples
-                batch_size = z.shape[0] * n_gen
+                batch_size = z_shape[0] * n_gen
                 if c is not None:
                     c = torch.cat([c] * n_gen, dim=0)
                 text = text * n_gen
@@ -2168,14 +2309,14 @@ class MusicLDM(DDPM):
                     )
 
                     best_index = []
-                    for i in range(z.shape[0]):
-                        candidates = similarity[i :: z.shape[0]]
+                    for i in range(z_shape[0]):
+                        candidates = similarity[i :: z_shape[0]]
                         max_index = torch.argmax(candidates).item()
-                        best_index.append(i + max_index * z.shape[0])
+                        best_index.append(i + max_index * z_shape[0])
                         # print("Similarity between generated audio and text", similarity)
                         # print("Choose the following indexes:", best_index)
                 else:
-                    best_index = torch.arange(z.shape[0])
+                    best_index = torch.arange(z_shape[0])
 
                 waveform = waveform[best_index]
                 
@@ -2574,14 +2715,32 @@ class DiffusionWrapper(pl.LightningModule):
             "film",
         ]
 
+    def get_film_embedding(self, c_film):
+        # c_film: [bs, 1, dim] global token -> projected FiLM embedding, reusable as c_film_emb
+        return self.diffusion_model.get_film_embedding(c_film.squeeze(1))
+
+    def get_time_embedding(self, timesteps):
+        # timesteps: [n] -> embedded timesteps, reusable as time_emb
+        return self.diffusion_model.get_time_embedding(timesteps)
+
     def forward(
-        self, x, t, c_concat: list = None, c_crossattn: list = None, c_film: list = None
+        self,
+        x,
+        t,
+        c_concat: list = None,
+        c_crossattn: list = None,
+        c_film: list = None,
+        c_film_emb: list = None,
+        time_emb: torch.Tensor = None,
     ):
         x = x.contiguous()
         t = t.contiguous()
 
         if self.conditioning_key is None:
             out = self.diffusion_model(x, t)
+        elif self.conditioning_key == "film" and c_film_emb is not None:
+            # FiLM projection already computed by the caller
+            out = self.diffusion_model(x, t, y_emb=c_film_emb[0], time_emb=time_emb)
         elif self.conditioning_key == "concat":
             xc = torch.cat([x] + c_concat, dim=1)
             out = self.diffusion_model(xc, t)
@@ -2596,7 +2755,7 @@ class DiffusionWrapper(pl.LightningModule):
             self.conditioning_key == "film"
         ):  # The condition is assumed to be a global token, which wil pass through a linear layer and added with the time embedding for the FILM
             cc = c_film[0].squeeze(1)  # only has one token
-            out = self.diffusion_model(x, t, y=cc)
+            out = self.diffusion_model(x, t, y=cc, time_emb=time_emb)
         elif self.conditioning_key == "adm":
             cc = c_crossattn[0]
             out = self.diffusion_model(x, t, y=cc)
@@ -0,0 +1,91 @@
+import math
+
+import torch
+
+
+def parse_prune_schedule(specs):
+    # ["0.25:0.4", "0.5:0.5"] -> [(0.25, 0.4), (0.5, 0.5)]
+    schedule = []
+    for spec in specs:
+        fraction, ratio = spec.split(":")
+        fraction, ratio = float(fraction), float(ratio)
+        if not 0.0 < fraction < 1.0 or not 0.0 < ratio <= 1.0:
+            raise ValueError("Invalid prune step %s, expected FRACTION:KEEP_RATIO in (0, 1)" % spec)
+        schedule.append((fraction, ratio))
+    return sorted(schedule)
+
+
+class CandidatePruner:
+    """Best-of-N search that drops weak candidates partway through DDIM sampling.
+
+    Passed to DDIMSampler.sample as prune_callback. Candidates are laid out as
+    [p_0, ..., p_B-1] * n_gen for B prompts. After the steps given by
+    `schedule`, a list of (fraction of the steps, keep ratio), the pred_x0
+    estimates are decoded, vocoded and scored with CLAP against their prompt's
+    text embedding, and the best ceil(ratio * n) candidates of every prompt
+    keep sampling. Survivors stay in the same interleaved layout.
+    """
+
+    def __init__(self, model, cond, n_prompts, schedule, total_steps, x0=None, mask=None):
+        self.model = model
+        # CLAP text embeddings [B * n_gen, 1, 512], scored without going through the text cache
+        self.cond = cond
+        self.n_prompts = n_prompts
+        self.x0 = x0
+        self.mask = mask
+        self.prune_steps = {
+            min(total_steps - 1, max(0, int(round(fraction * total_steps)) - 1)): ratio
+            for fraction, ratio in schedule
+        }
+        self.total_steps = total_steps
+        self.alive = torch.arange(cond.size(0))
+        self.candidate_steps = 0
+        self.n_scored = 0
+        self.history = []
+
+    @property
+    def n_candidates(self):
+        return self.alive.size(0) // self.n_prompts
+
+    def __call__(self, i, img, pred_x0):
+        self.candidate_steps += img.size(0)
+        if i not in self.prune_steps or self.n_candidates == 1:
+            return None
+
+        if self.mask is not None:
+            # the kept part of a continuation is known, only score the generated part
+            mask = self.mask[self.alive.to(self.mask.device)]
+            pred_x0 = self.x0[self.alive.to(self.x0.device)] * mask + (1.0 - mask) * pred_x0
+        mel = self.model.decode_first_stage(pred_x0)
+        waveform = self.model.mel_spectrogram_to_waveform(mel, save=False)
+        similarity = self.model.cond_stage_model.cos_similarity_c(
+            torch.FloatTensor(waveform).squeeze(1), self.cond[self.alive.to(self.cond.device)]
+        ).view(-1).cpu()
+        self.n_scored += similarity.size(0)
+
+        n_keep = max(1, int(math.ceil(self.prune_steps[i] * self.n_candidates)))
+        ranked = [
+            torch.argsort(similarity[p :: self.n_prompts], descending=True)[:n_keep] * self.n_prompts + p
+            for p in range(self.n_prompts)
+        ]
+        # rank-major order keeps the [p_0, ..., p_B-1] * n layout
+        keep = torch.stack(ranked, dim=1).reshape(-1)
+        self.history.append(
+            {"step": i + 1, "scores": similarity, "kept": self.alive[keep].tolist()}
+        )
+        print(
+            "Pruning at step %s/%s: keeping %s of %s candidates per prompt"
+            % (i + 1, self.total_steps, n_keep, self.n_candidates)
+        )
+        self.alive = self.alive[keep]
+        return keep.to(img.device)
+
+    def report(self):
+        full = self.cond.size(0) * self.total_steps
+        return {
+            "unet_candidate_steps": self.candidate_steps,
+            "unet_candidate_steps_without_pruning": full,
+            "unet_compute_saving": full / max(1, self.candidate_steps),
+            "pred_x0_candidates_scored": self.n_scored,
+            "survivors": self.alive.tolist(),
+        }
@@ -0,0 +1,107 @@
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def _shifted_l1(x, y, lags, chunk_size=64):
+    # mean(|x[..., i:] - y[..., :-i]|) for every lag i, x and y: [bs, L]
+    bs, length = x.shape
+    max_lag = int(lags.max())
+    # windows[:, i] is x[i:] followed by zeros
+    windows = F.pad(x, (0, max_lag)).unfold(1, length, 1)
+    positions = torch.arange(length, device=x.device)
+    costs = []
+    for start in range(0, len(lags), chunk_size):
+        chunk = lags[start : start + chunk_size]
+        valid = positions.unsqueeze(0) < (length - chunk).unsqueeze(1)
+        distance = (windows[:, chunk] - y.unsqueeze(1)).abs() * valid
+        costs.append(distance.sum(-1) / (length - chunk))
+    return torch.cat(costs, dim=1)
+
+
+def _shifted_l2(x, y, lags):
+    # mean((x[..., i:] - y[..., :-i]) ** 2) for every lag i, through an FFT cross-correlation
+    x, y = x.double(), y.double()
+    length = x.size(-1)
+    n_fft = 2 * length
+    xcorr = torch.fft.irfft(
+        torch.fft.rfft(x, n=n_fft) * torch.fft.rfft(y, n=n_fft).conj(), n=n_fft
+    )[:, lags]
+    # sum(x[i:] ** 2) and sum(y[:L - i] ** 2)
+    x_energy = torch.flip(torch.cumsum(torch.flip(x**2, [-1]), -1), [-1])[:, lags]
+    y_energy = torch.cumsum(y**2, -1)[:, length - 1 - lags]
+    return ((x_energy + y_energy - 2 * xcorr) / (length - lags)).clamp(min=0).float()
+
+
+def alignment_costs(waveform1, waveform2, margin=1000, method="l1"):
+    """Distance between two overlapping waveforms for every stitching offset.
+
+    waveform1, waveform2: [bs, 1, t-steps] tensors of the same length.
+    Returns the offsets 2..margin-1 followed by -2..-(margin-1), and their costs
+    per waveform as a [bs, n_offsets] tensor. A positive offset i compares
+    waveform1[..., i:] with waveform2[..., :-i], a negative one the reverse.
+    method "l1" is the mean absolute difference, "fft" the mean squared
+    difference computed for all offsets at once in the frequency domain.
+    """
+    x = waveform1.reshape(waveform1.size(0), -1).float()
+    y = waveform2.reshape(waveform2.size(0), -1).float()
+    lags = torch.arange(2, margin, device=x.device)
+    if method == "l1":
+        costs = torch.cat([_shifted_l1(x, y, lags), _shifted_l1(y, x, lags)], dim=1)
+    elif method == "fft":
+        costs = torch.cat([_shifted_l2(x, y, lags), _shifted_l2(y, x, lags)], dim=1)
+    else:
+        raise ValueError("Unknown alignment method %s" % method)
+    return torch.cat([lags, -lags]), costs
+
+
+def find_best_waveform_alignment(waveform1, waveform2, margin=1000, method="l1"):
+    # one offset shared by the whole batch, as the waveforms are concatenated together
+    offsets, costs = alignment_costs(waveform1, waveform2, margin=margin, method=method)
+    return int(offsets[torch.argmin(costs.mean(0))])
+
+
+def _find_best_waveform_alignment_loop(waveform1, waveform2, margin=1000):
+    # The original per-offset search, kept as a reference for the benchmark
+    diff = 32768
+    best_offset = None
+    for i in range(2, margin):
+        waveform_distance = np.mean(np.abs(waveform1[..., i:] - waveform2[..., :-i]))
+        if waveform_distance < diff:
+            best_offset = i
+            diff = waveform_distance
+    for i in range(2, margin):
+        waveform_distance = np.mean(np.abs(waveform2[..., i:] - waveform1[..., :-i]))
+        if waveform_distance < diff:
+            best_offset = -i
+            diff = waveform_distance
+    return best_offset
+
+
+if __name__ == "__main__":
+    # Micro-benchmark against the loop: PYTHONPATH=src python src/latent_diffusion/modules/alignment.py
+    bs, length, true_offset = 2, 163872 // 4, 137
+    t = np.arange(length + true_offset) / 16000
+    signal = np.sin(2 * np.pi * 220 * t) * np.sin(2 * np.pi * 3 * t) + 0.1 * np.random.randn(bs, 1, len(t))
+    waveform1 = signal[..., true_offset:].astype(np.float32)
+    waveform2 = signal[..., :length].astype(np.float32)
+
+    start = time.time()
+    loop_offset = _find_best_waveform_alignment_loop(waveform1, waveform2)
+    print("numpy loop: offset %s in %.3f s" % (loop_offset, time.time() - start))
+
+    devices = ["cpu"] + (["cuda"] if torch.cuda.is_available() else [])
+    for device in devices:
+        w1 = torch.from_numpy(waveform1).to(device)
+        w2 = torch.from_numpy(waveform2).to(device)
+        for method in ["l1", "fft"]:
+            find_best_waveform_alignment(w1, w2, method=method)
+            if device == "cuda":
+                torch.cuda.synchronize()
+            start = time.time()
+            offset = find_best_waveform_alignment(w1, w2, method=method)
+            if device == "cuda":
+                torch.cuda.synchronize()
+            print("torch %s %s: offset %s in %.3f s" % (method, device, offset, time.time() - start))
@@ -5,7 +5,8 @@ import torch.nn.functional as F
 from torch import nn, einsum
 from einops import rearrange, repeat
 
-from latent_diffusion.modules.diffusionmodules.util import checkpoint
+from latent_diffusion.modules.diffusionmodules.util import checkpoint_in_training
+from latent_diffusion.modules.attention_backends import attention, get_attention_backend
 
 
 def exists(val):
@@ -275,10 +276,10 @@ class CrossAttention(nn.Module):
         # Compute attention
         # $$\underset{seq}{softmax}\Bigg(\frac{Q K^\top}{\sqrt{d_{key}}}\Bigg)V$$
         # This gives a tensor of shape `[batch_size, seq_len, n_heads, d_padded]`
-        # TODO here I add the dtype changing
-        out, _ = self.flash(qkv.type(torch.float16))
+        # flash attention only runs in half precision, keep bf16 under a bf16 autocast
+        out, _ = self.flash(qkv.type(torch.bfloat16 if qkv.dtype == torch.bfloat16 else torch.float16))
         # Truncate the extra head size
-        out = out[:, :, :, : self.d_head].float()
+        out = out[:, :, :, : self.d_head].to(q.dtype)
         # Reshape to `[batch_size, seq_len, n_heads * d_head]`
         out = out.reshape(batch_size, seq_len, self.n_heads * self.d_head)
 
@@ -294,6 +295,12 @@ class CrossAttention(nn.Module):
         :param v: are the query vectors before splitting heads, of shape `[batch_size, seq, d_attn]`
         """
 
+        if get_attention_backend() != "einsum":
+            # `[batch_size, n_heads, seq_len, d_head]` for the attention backend
+            q, k, v = (t.view(*t.shape[:2], self.n_heads, -1).transpose(1, 2) for t in (q, k, v))
+            out = attention(q, k, v).transpose(1, 2)
+            return self.to_out(out.reshape(*out.shape[:2], -1))
+
         # Split them to heads of shape `[batch_size, seq_len, n_heads, d_head]`
         q = q.view(*q.shape[:2], self.n_heads, -1)  # [bs, 64, 20, 32]
         k = k.view(*k.shape[:2], self.n_heads, -1)  # [bs, 1, 20, 32]
@@ -395,12 +402,9 @@ class BasicTransformerBlock(nn.Module):
         self.checkpoint = checkpoint
 
     def forward(self, x, context=None):
-        if context is None:
-            return checkpoint(self._forward, (x,), self.parameters(), self.checkpoint)
-        else:
-            return checkpoint(
-                self._forward, (x, context), self.parameters(), self.checkpoint
-            )
+        if not self.checkpoint:
+            return self._forward(x, context)
+        return checkpoint_in_training(self, self._forward, x, context)
 
     def _forward(self, x, context=None):
         x = self.attn1(self.norm1(x)) + x
@@ -0,0 +1,86 @@
+from contextlib import nullcontext
+
+import torch
+import torch.nn.functional as F
+
+try:
+    from torch.nn.attention import SDPBackend, sdpa_kernel
+except ImportError:
+    # older torch only has the deprecated torch.backends.cuda.sdp_kernel
+    SDPBackend, sdpa_kernel = None, None
+
+# sdpa*: torch.nn.functional.scaled_dot_product_attention, letting torch pick the kernel or
+#        restricting CUDA to the memory-efficient or math kernel
+# chunked: query chunks whose attention matrix fits in a memory cap
+# einsum: the original full-matrix code of every attention layer, for parity tests
+BACKENDS = ["sdpa", "sdpa_efficient", "sdpa_math", "chunked", "einsum"]
+
+_config = {
+    "backend": "sdpa" if hasattr(F, "scaled_dot_product_attention") else "einsum",
+    "chunk_memory_mb": 256,
+    "logged": False,
+}
+
+
+def set_attention_backend(backend, chunk_memory_mb=None):
+    if backend not in BACKENDS:
+        raise ValueError("Unknown attention backend %s, expected one of %s" % (backend, BACKENDS))
+    if backend.startswith("sdpa") and not hasattr(F, "scaled_dot_product_attention"):
+        raise ValueError("Attention backend %s needs torch>=2.0" % backend)
+    _config["backend"] = backend
+    if chunk_memory_mb is not None:
+        _config["chunk_memory_mb"] = chunk_memory_mb
+    _config["logged"] = False
+    _log_backend()
+
+
+def get_attention_backend():
+    if not _config["logged"]:
+        _log_backend()
+    return _config["backend"]
+
+
+def _log_backend():
+    backend = _config["backend"]
+    if backend == "chunked":
+        backend += " (%s MB attention matrix cap)" % _config["chunk_memory_mb"]
+    print("Attention backend: %s" % backend)
+    _config["logged"] = True
+
+
+def _sdpa_kernel(backend, device):
+    # the kernel restrictions only apply to CUDA, other devices let torch pick
+    if backend == "sdpa" or device.type != "cuda":
+        return nullcontext()
+    if sdpa_kernel is not None:
+        return sdpa_kernel(SDPBackend.MATH if backend == "sdpa_math" else SDPBackend.EFFICIENT_ATTENTION)
+    return torch.backends.cuda.sdp_kernel(
+        enable_flash=False,
+        enable_math=backend == "sdpa_math",
+        enable_mem_efficient=backend == "sdpa_efficient",
+    )
+
+
+def chunked_attention(q, k, v, chunk_memory_mb):
+    # softmax(q k^T / sqrt(d)) v over query chunks, scores in float32
+    scale = q.size(-1) ** -0.5
+    rows = q[..., 0, 0].numel()
+    chunk = max(1, int(chunk_memory_mb * 2**20 // (4 * rows * k.size(-2))))
+    out = []
+    for start in range(0, q.size(-2), chunk):
+        weight = torch.matmul(q[..., start : start + chunk, :], k.transpose(-1, -2)) * scale
+        out.append(torch.matmul(weight.float().softmax(dim=-1).type(v.dtype), v))
+    return torch.cat(out, dim=-2)
+
+
+def attention(q, k, v):
+    """softmax(q k^T / sqrt(d)) v with the selected backend.
+
+    q: [..., seq_q, d], k and v: [..., seq_k, d]. Callers run their own einsum
+    code when the backend is "einsum".
+    """
+    backend = get_attention_backend()
+    if backend == "chunked":
+        return chunked_attention(q, k, v, _config["chunk_memory_mb"])
+    with _sdpa_kernel(backend, q.device):
+        return F.scaled_dot_product_attention(q, k, v)
@@ -7,6 +7,8 @@ from einops import rearrange
 
 from latent_diffusion.util import instantiate_from_config
 from latent_diffusion.modules.attention import LinearAttention
+from latent_diffusion.modules.attention_backends import attention, get_attention_backend
+from latent_diffusion.modules.diffusionmodules.util import GroupNorm32
 
 
 def get_timestep_embedding(timesteps, embedding_dim):
@@ -36,7 +38,8 @@ def nonlinearity(x):
 
 
 def Normalize(in_channels, num_groups=32):
-    return torch.nn.GroupNorm(
+    # statistics in float32 under a half precision autocast
+    return GroupNorm32(
         num_groups=num_groups, num_channels=in_channels, eps=1e-6, affine=True
     )
 
@@ -210,6 +213,10 @@ class AttnBlock(nn.Module):
 
         # compute attention
         b, c, h, w = q.shape
+        if get_attention_backend() != "einsum":
+            q, k, v = (t.reshape(b, c, h * w).transpose(1, 2) for t in (q, k, v))  # b,hw,c
+            h_ = attention(q, k, v).transpose(1, 2).reshape(b, c, h, w)
+            return x + self.proj_out(h_)
         q = q.reshape(b, c, h * w).contiguous()
         q = q.permute(0, 2, 1).contiguous()  # b,hw,c
         k = k.reshape(b, c, h * w).contiguous()  # b,c,hw
@@ -10,6 +10,7 @@ import torch.nn.functional as F
 
 from latent_diffusion.modules.diffusionmodules.util import (
     checkpoint,
+    checkpoint_in_training,
     conv_nd,
     linear,
     avg_pool_nd,
@@ -18,6 +19,7 @@ from latent_diffusion.modules.diffusionmodules.util import (
     timestep_embedding,
 )
 from latent_diffusion.modules.attention import SpatialTransformer
+from latent_diffusion.modules.attention_backends import attention, get_attention_backend
 
 
 # dummy replace
@@ -325,10 +327,8 @@ class AttentionBlock(nn.Module):
         self.proj_out = zero_module(conv_nd(1, channels, channels, 1))
 
     def forward(self, x):
-        return checkpoint(
-            self._forward, (x,), self.parameters(), True
-        )  # TODO: check checkpoint usage, is True # TODO: fix the .half call!!!
-        # return pt_checkpoint(self._forward, x)  # pytorch
+        # always checkpointed in training, a direct call when sampling
+        return checkpoint_in_training(self, self._forward, x)
 
     def _forward(self, x):
         b, c, *spatial = x.shape
@@ -380,6 +380,9 @@ class QKVAttentionLegacy(nn.Module):
         q, k, v = (
             qkv.reshape(bs * self.n_heads, ch * 3, length).contiguous().split(ch, dim=1)
         )
+        if get_attention_backend() != "einsum":
+            a = attention(q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2))
+            return a.transpose(1, 2).reshape(bs, -1, length).contiguous()
         scale = 1 / math.sqrt(math.sqrt(ch))
         weight = th.einsum(
             "bct,bcs->bts", q * scale, k * scale
@@ -412,6 +415,9 @@ class QKVAttention(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.chunk(3, dim=1)
+        if get_attention_backend() != "einsum":
+            q, k, v = (t.reshape(bs * self.n_heads, ch, length).transpose(1, 2) for t in (q, k, v))
+            return attention(q, k, v).transpose(1, 2).reshape(bs, -1, length).contiguous()
         scale = 1 / math.sqrt(math.sqrt(ch))
         weight = th.einsum(
             "bct,bcs->bts",
@@ -799,6 +805,8 @@ class UNetModel(nn.Module):
             )
 
         self.shape_reported = False
+        # optional DeepFeatureCache, see latent_diffusion.models.deep_cache
+        self.feature_cache = None
 
     def convert_to_fp16(self):
         """
@@ -816,41 +824,81 @@ class UNetModel(nn.Module):
         self.middle_block.apply(convert_module_to_f32)
         self.output_blocks.apply(convert_module_to_f32)
 
-    def forward(self, x, timesteps=None, context=None, y=None, **kwargs):
+    def get_film_embedding(self, y):
+        """
+        Project an [N, extra_film_condition_dim] condition into the FiLM embedding.
+        The result can be passed to forward() as y_emb to skip the projection
+        when the same condition is reused across denoising steps.
+        """
+        return self.film_emb(y)
+
+    def get_time_embedding(self, timesteps):
+        """
+        Embed a 1-D batch of timesteps. The result can be passed to forward()
+        as time_emb, e.g. for a table of all timesteps of a sampling run.
+        """
+        t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
+        return self.time_embed(t_emb)
+
+    def forward(self, x, timesteps=None, context=None, y=None, y_emb=None, time_emb=None, **kwargs):
         """
         Apply the model to an input batch.
         :param x: an [N x C x ...] Tensor of inputs.
         :param timesteps: a 1-D batch of timesteps.
         :param context: conditioning plugged in via crossattn
         :param y: an [N] Tensor of labels, if class-conditional. an [N, extra_film_condition_dim] Tensor if film-embed conditional
+        :param y_emb: an optional precomputed get_film_embedding(y), used instead of y.
+        :param time_emb: an optional precomputed get_time_embedding(timesteps), used instead of timesteps.
         :return: an [N x C x ...] Tensor of outputs.
         """
         if not self.shape_reported:
             print("The shape of UNet input is", x.size())
             self.shape_reported = True
 
-        assert (y is not None) == (
+        assert (y is not None or y_emb is not None) == (
             self.num_classes is not None or self.extra_film_condition_dim is not None
         ), "must specify y if and only if the model is class-conditional or film embedding conditional"
         hs = []
-        t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
-        emb = self.time_embed(t_emb)
+        if time_emb is None:
+            time_emb = self.get_time_embedding(timesteps)
+        emb = time_emb
 
         if self.num_classes is not None:
             assert y.shape == (x.shape[0],)
             emb = emb + self.label_emb(y)
 
-        if self.use_extra_film_by_addition:
-            emb = emb + self.film_emb(y)
-        elif self.use_extra_film_by_concat:
-            emb = th.cat([emb, self.film_emb(y)], dim=-1)
+        if self.use_extra_film_by_addition or self.use_extra_film_by_concat:
+            if y_emb is None:
+                y_emb = self.film_emb(y)
+            if self.use_extra_film_by_addition:
+                emb = emb + y_emb
+            else:
+                emb = th.cat([emb, y_emb], dim=-1)
 
         h = x.type(self.dtype)
-        for module in self.input_blocks:
-            h = module(h, emb, context)
-            hs.append(h)
-        h = self.middle_block(h, emb, context)
-        for module in self.output_blocks:
+        cache = self.feature_cache
+        if cache is not None and not self.training and cache.reuse(x):
+            # only the shallow blocks, on top of the cached deep feature
+            for module in self.input_blocks[: cache.depth]:
+                h = module(h, emb, context)
+                hs.append(h)
+            h = cache.h
+            cache.cached_steps += 1
+            output_blocks = self.output_blocks[-cache.depth :]
+        else:
+            for module in self.input_blocks:
+                h = module(h, emb, context)
+                hs.append(h)
+            h = self.middle_block(h, emb, context)
+            output_blocks = self.output_blocks
+            if cache is not None and not self.training:
+                deep = len(self.output_blocks) - cache.depth
+                for module in self.output_blocks[:deep]:
+                    h = th.cat([h, hs.pop()], dim=1)
+                    h = module(h, emb, context)
+                cache.store(h)
+                output_blocks = self.output_blocks[deep:]
+        for module in output_blocks:
             h = th.cat([h, hs.pop()], dim=1)
             h = module(h, emb, context)
         h = h.type(x.dtype)
@@ -11,6 +11,7 @@
 import os
 import math
 import torch
+import torch.utils.checkpoint
 import torch.nn as nn
 import numpy as np
 from einops import repeat
@@ -138,6 +139,17 @@ def checkpoint(func, inputs, params, flag):
         return func(*inputs)
 
 
+def checkpoint_in_training(module, func, *inputs):
+    """
+    Gradient checkpointing that only runs while `module` trains with gradients enabled,
+    using PyTorch's non-reentrant checkpoint. In eval mode or under no_grad (sampling)
+    func is called directly, without any autograd bookkeeping.
+    """
+    if module.training and torch.is_grad_enabled():
+        return torch.utils.checkpoint.checkpoint(func, *inputs, use_reentrant=False)
+    return func(*inputs)
+
+
 class CheckpointFunction(torch.autograd.Function):
     @staticmethod
     def forward(ctx, run_function, length, *args):
@@ -1,12 +1,14 @@
+import threading
 import torch
 import torch.nn as nn
+from collections import OrderedDict
 from functools import partial
 # import clip
 from einops import rearrange, repeat
 from transformers import CLIPTokenizer, CLIPTextModel
 # import kornia
 from clap.clap_module import create_model
-from clap.training.data import get_audio_features
+import numpy as np
 from latent_diffusion.util import float32_to_int16, int16_to_float32
 import torchaudio
 from latent_diffusion.modules.x_transformer import Encoder, TransformerWrapper
@@ -25,6 +27,8 @@ class CLAPAudioEmbeddingClassifierFreev2(nn.Module):
         random_mute=False,
         max_random_mute_portion=0.5,
         training_mode=True,
+        text_embedding_cache_size=256,
+        text_model_path=None,
     ):
         super().__init__()
         self.device = "cpu"
@@ -39,9 +43,12 @@ class CLAPAudioEmbeddingClassifierFreev2(nn.Module):
         self.sampling_rate = sampling_rate
         self.unconditional_prob = unconditional_prob
         self.random_mute = random_mute
-        self.tokenize = RobertaTokenizer.from_pretrained("roberta-base")
+        # text_model_path: local tokenizer and RoBERTa config files, for offline loading
+        self.tokenize = RobertaTokenizer.from_pretrained(text_model_path or "roberta-base")
         self.max_random_mute_portion = max_random_mute_portion
         self.training_mode = training_mode
+        # dtype the towers compute in under autocast, set by MusicLDM.set_precision_policy
+        self.compute_dtype = torch.float32
         self.model, self.model_cfg = create_model(
             self.amodel,
             self.tmodel,
@@ -50,17 +57,150 @@ class CLAPAudioEmbeddingClassifierFreev2(nn.Module):
             device=self.device,
             enable_fusion=self.enable_fusion,
             fusion_type=self.fusion_type,
+            text_config_path=text_model_path,
         )
         for p in self.model.parameters():
             p.requires_grad = False
 
         self.model.eval()
 
+        # The CLAP towers are frozen, so text embeddings only depend on the prompt
+        # string and the device/dtype the model lives on. The caches, their counters and
+        # the tokenizer are guarded by a lock, text embeddings are prefetched on a worker thread.
+        self.text_embedding_cache_size = text_embedding_cache_size
+        self._embedding_cache_lock = threading.RLock()
+        self.clear_embedding_cache()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_embedding_cache_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._embedding_cache_lock = threading.RLock()
+
+    def clear_embedding_cache(self):
+        with self._embedding_cache_lock:
+            self.unconditional_token = None
+            self._unconditional_token_key = None
+            self._text_embedding_cache = OrderedDict()
+            self._text_embedding_cache_key = None
+            self.text_embedding_cache_hits = 0
+            self.text_embedding_cache_misses = 0
+
+    def embedding_cache_info(self):
+        with self._embedding_cache_lock:
+            return {
+                "hits": self.text_embedding_cache_hits,
+                "misses": self.text_embedding_cache_misses,
+                "size": len(self._text_embedding_cache),
+                "maxsize": self.text_embedding_cache_size,
+            }
+
+    @property
+    def model_device(self):
+        return next(self.model.parameters()).device
+
+    def _embedding_cache_key(self):
+        param = next(self.model.parameters())
+        return (param.device, param.dtype, self.compute_dtype)
+
+    def _autocast(self, dtype=None):
+        dtype = self.compute_dtype if dtype is None else dtype
+        return torch.autocast(
+            device_type=self.model_device.type, dtype=dtype, enabled=dtype != torch.float32
+        )
+
+    def get_unconditional_token(self):
+        # [1, 512], computed once per device/dtype
+        with self._embedding_cache_lock:
+            key = self._embedding_cache_key()
+            if self.unconditional_token is None or self._unconditional_token_key != key:
+                with torch.no_grad(), self._autocast():
+                    self.unconditional_token = self.model.get_text_embedding(
+                        self.tokenizer(["", ""])
+                    )[0:1].detach().float()
+                self._unconditional_token_key = key
+            return self.unconditional_token
+
+    def get_text_embedding(self, texts):
+        # texts: list of prompt strings -> [bs, 512]; safe to call from several threads
+        with self._embedding_cache_lock:
+            return self._get_text_embedding(texts)
+
+    def _get_text_embedding(self, texts):
+        key = self._embedding_cache_key()
+        if self._text_embedding_cache_key != key:
+            self._text_embedding_cache.clear()
+            self._text_embedding_cache_key = key
+
+        missing = []
+        for text in texts:
+            if text in self._text_embedding_cache:
+                self._text_embedding_cache.move_to_end(text)
+                self.text_embedding_cache_hits += 1
+            else:
+                if text not in missing:
+                    missing.append(text)
+                self.text_embedding_cache_misses += 1
+
+        computed = {}
+        for text in missing:
+            # One prompt per batch, so an embedding does not depend on which other prompts
+            # were missing from the cache (a resumed run embeds the same values on GPU).
+            # The tokenizer squeezes a batch of one, so the prompt is embedded twice.
+            with torch.no_grad(), self._autocast():
+                embed = self.model.get_text_embedding(self.tokenizer([text, text]))[0].detach().float()
+            computed[text] = embed
+            if self.text_embedding_cache_size > 0:
+                self._text_embedding_cache[text] = embed
+        while len(self._text_embedding_cache) > self.text_embedding_cache_size:
+            self._text_embedding_cache.popitem(last=False)
+
+        return torch.stack(
+            [
+                computed[text] if text in computed else self._text_embedding_cache[text]
+                for text in texts
+            ],
+            dim=0,
+        )
+
+    def get_audio_features(self, waveform, max_len=480000):
+        # Batched equivalent of clap.training.data.get_audio_features with
+        # data_truncating="rand_trunc" and data_filling="repeatpad".
+        # waveform: [bs, t-samples] at 48kHz, all of the same length
+        bs, t_samples = waveform.shape
+        if t_samples > max_len:
+            # random crop to max_len, one offset per waveform
+            offsets = np.random.randint(0, t_samples - max_len + 1, size=bs)
+            index = torch.as_tensor(offsets, device=waveform.device).unsqueeze(1) + torch.arange(
+                max_len, device=waveform.device
+            ).unsqueeze(0)
+            waveform = torch.gather(waveform, 1, index)
+            longer = torch.ones(bs, 1, dtype=torch.bool, device=waveform.device)
+        else:
+            if t_samples < max_len:
+                n_repeat = int(max_len / t_samples)
+                waveform = waveform.repeat(1, n_repeat)
+                waveform = F.pad(
+                    waveform, (0, max_len - waveform.size(1)), mode="constant", value=0
+                )
+            longer = torch.zeros(bs, 1, dtype=torch.bool, device=waveform.device)
+        return {"waveform": waveform, "longer": longer}
+
+    def get_audio_embedding(self, waveform):
+        # waveform: [bs, t-samples] at 48kHz -> [bs, 512]
+        device = self.model_device
+        input_dict = self.get_audio_features(waveform.to(device))
+        with self._autocast():
+            embed = self.model.encode_audio(input_dict, device=device)["embedding"]
+            embed = self.model.audio_projection(embed)
+        return F.normalize(embed.float(), dim=-1)
+
     def get_unconditional_condition(self, batchsize):
-        self.unconditional_token = self.model.get_text_embedding(
-            self.tokenizer(["", ""])
-        )[0:1]
-        return torch.cat([self.unconditional_token.unsqueeze(0)] * batchsize, dim=0)
+        unconditional_token = self.get_unconditional_token()
+        return torch.cat([unconditional_token.unsqueeze(0)] * batchsize, dim=0)
 
     def batch_to_list(self, batch):
         ret = []
@@ -93,7 +233,7 @@ class CLAPAudioEmbeddingClassifierFreev2(nn.Module):
         # waveform: [bs, t_steps]
         with torch.no_grad():
             self.embed_mode = "audio"
-            audio_emb = self(waveform.cuda())
+            audio_emb = self(waveform.to(self.model_device))
             self.embed_mode = "text"
             text_emb = self(text)
             similarity = F.cosine_similarity(audio_emb, text_emb, dim=2)
@@ -103,7 +243,7 @@ class CLAPAudioEmbeddingClassifierFreev2(nn.Module):
         # waveform: [bs, t_steps]
         with torch.no_grad():
             self.embed_mode = "audio"
-            audio_emb = self(waveform.cuda())
+            audio_emb = self(waveform.to(self.model_device))
             self.embed_mode = "text"
             text_emb = c #self(text)
             similarity = F.cosine_similarity(audio_emb, text_emb, dim=2)
@@ -121,13 +261,14 @@ class CLAPAudioEmbeddingClassifierFreev2(nn.Module):
                 self.tmodel,
                 self.pretrained,
                 precision=self.precision,
-                device="cuda",
+                device=self.model_device,
                 enable_fusion=self.enable_fusion,
                 fusion_type=self.fusion_type,
             )
             for p in self.model.parameters():
                 p.requires_grad = False
             self.model.eval()
+            self.clear_embedding_cache()
 
         # if(self.training_mode):
         #     assert self.model.training == True
@@ -137,42 +278,28 @@ class CLAPAudioEmbeddingClassifierFreev2(nn.Module):
         # the 'fusion' truncate mode can be changed to 'rand_trunc' if run in unfusion mode
         if self.embed_mode == "audio":
             with torch.no_grad():
-                audio_dict_list = []
                 assert (
                     self.sampling_rate == 16000
                 ), "We only support 16000 sampling rate"
                 if self.random_mute:
                     batch = self._random_mute(batch)
-                # batch: [bs, 1, t-samples]
+                # batch: [bs, t-samples]
+                batch = batch.reshape(batch.size(0), -1)
                 batch = torchaudio.functional.resample(
                     batch, orig_freq=self.sampling_rate, new_freq=48000
                 )
-                for waveform in self.batch_to_list(batch):
-                    audio_dict = {}
-                    audio_dict = get_audio_features(
-                        audio_dict,
-                        waveform,
-                        480000,
-                        data_truncating="rand_trunc",
-                        data_filling="repeatpad",
-                        audio_cfg=self.model_cfg["audio_cfg"],
-                    )
-                    audio_dict_list.append(audio_dict)
                 # [bs, 512]
-                embed = self.model.get_audio_embedding(audio_dict_list)
+                embed = self.get_audio_embedding(batch)
         elif self.embed_mode == "text":
             with torch.no_grad():
                 # the 'fusion' truncate mode can be changed to 'rand_trunc' if run in unfusion mode
-                text_data = self.tokenizer(batch)
-                embed = self.model.get_text_embedding(text_data)
+                embed = self.get_text_embedding(list(batch))
         embed = embed.unsqueeze(1)
-        self.unconditional_token = self.model.get_text_embedding(
-            self.tokenizer(["", ""])
-        )[0:1]
+        unconditional_token = self.get_unconditional_token()
 
         for i in range(embed.size(0)):
             if self.make_decision(self.unconditional_prob):
-                embed[i] = self.unconditional_token
+                embed[i] = unconditional_token
         # [bs, 1, 512]
         return embed.detach()
 
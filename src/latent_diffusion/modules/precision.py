@@ -0,0 +1,72 @@
+import torch
+
+DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+COMPONENTS = ["unet", "vae", "vocoder", "clap"]
+
+
+def to_float(output):
+    if torch.is_tensor(output):
+        return output.float() if output.is_floating_point() else output
+    if isinstance(output, (tuple, list)):
+        return type(output)(to_float(x) for x in output)
+    return output
+
+
+class PrecisionPolicy:
+    """Compute precision of every inference component.
+
+    Components run under autocast in their dtype while their weights stay in
+    float32: matmuls and convolutions use the lower precision, normalizations
+    and softmax stay in float32. Outputs are cast back to float32, so the
+    sampler's schedule math (alphas, guidance, the DDIM update), the VAE
+    scaling and the numpy conversion of waveforms always run in float32.
+    """
+
+    def __init__(self, unet="fp32", vae="fp32", vocoder="fp32", clap="fp32"):
+        self.precisions = {"unet": unet, "vae": vae, "vocoder": vocoder, "clap": clap}
+        for component, precision in self.precisions.items():
+            if precision not in DTYPES:
+                raise ValueError("Unknown precision %s for %s, expected one of %s" % (precision, component, list(DTYPES)))
+
+    @classmethod
+    def parse(cls, spec):
+        # "bf16" for every component, or per component e.g. "unet=bf16,vae=bf16,clap=fp16"
+        if "=" not in spec:
+            return cls(**{component: spec for component in COMPONENTS})
+        precisions = {}
+        for item in spec.split(","):
+            component, precision = item.split("=")
+            if component not in COMPONENTS:
+                raise ValueError("Unknown component %s, expected one of %s" % (component, COMPONENTS))
+            precisions[component] = precision
+        return cls(**precisions)
+
+    def dtype(self, component):
+        return DTYPES[self.precisions[component]]
+
+    def check_device(self, device):
+        if torch.device(device).type != "cuda" and "fp16" in self.precisions.values():
+            raise ValueError("fp16 autocast needs a CUDA device, use bf16 on %s" % device)
+
+    def __str__(self):
+        return ",".join("%s=%s" % item for item in self.precisions.items())
+
+
+def autocast_method(module, name, dtype):
+    """Run module.<name> under autocast in dtype and return float32 outputs.
+
+    The method is replaced on the instance only, so every caller (samplers,
+    streaming vocoder, pruning) picks it up. float32 restores the original.
+    """
+    module.__dict__.pop(name, None)
+    if dtype == torch.float32:
+        return
+    method = getattr(module, name)
+
+    def autocast_wrapper(*args, **kwargs):
+        device = next(module.parameters()).device
+        with torch.autocast(device_type=device.type, dtype=dtype):
+            output = method(*args, **kwargs)
+        return to_float(output)
+
+    module.__dict__[name] = autocast_wrapper
@@ -388,12 +388,15 @@ class AutoencoderKL(pl.LightningModule):
         self.encoder = Encoder(**ddconfig)
         self.decoder = Decoder(**ddconfig)
 
-        self.loss = LPIPSWithDiscriminator(
-            disc_start=lossconfig['params']['disc_start'],
-            kl_weight=lossconfig['params']['kl_weight'],
-            disc_weight=lossconfig['params']['disc_weight'],
-            disc_in_channels=lossconfig['params']['disc_in_channels']
-        ) 
+        # lossconfig=None builds the autoencoder for inference only, without the training loss
+        self.loss = None
+        if lossconfig is not None:
+            self.loss = LPIPSWithDiscriminator(
+                disc_start=lossconfig['params']['disc_start'],
+                kl_weight=lossconfig['params']['kl_weight'],
+                disc_weight=lossconfig['params']['disc_weight'],
+                disc_in_channels=lossconfig['params']['disc_in_channels']
+            )
 
         self.subband = int(subband)
 
@@ -1,3 +1,4 @@
 from .audio_processing import *
 from .stft import *
 from .tools import *
+from .writer import IncrementalAudioWriter
@@ -0,0 +1,106 @@
+import os
+import struct
+
+import numpy as np
+import soundfile as sf
+
+WAV_HEADER_SIZE = 44
+
+
+class IncrementalAudioWriter:
+    """Append-only mono/multichannel 16 bit audio file for long generations.
+
+    WAV files are written directly: samples are appended to the data chunk and
+    the RIFF and data sizes in the header are patched on every flush and on
+    close, so the file is playable while it is still growing. FLAC goes through
+    soundfile, which finalizes the stream header on close.
+
+    `resume_frames` reopens an existing WAV file written by this class and
+    drops everything after that many frames.
+    """
+
+    def __init__(self, path, samplerate=16000, channels=1, resume_frames=None):
+        self.path = path
+        self.samplerate = samplerate
+        self.channels = channels
+        self.format = os.path.splitext(path)[1][1:].lower() or "wav"
+        self.block_align = 2 * channels
+        self.frames = 0
+
+        if self.format == "wav":
+            if resume_frames is None:
+                self._file = open(path, "w+b")
+                self._file.write(self._wav_header(0))
+            else:
+                self._file = open(path, "r+b")
+                header = self._file.read(WAV_HEADER_SIZE)
+                if header[:4] != b"RIFF" or header[36:40] != b"data":
+                    raise ValueError("%s was not written by IncrementalAudioWriter" % path)
+                self._file.truncate(WAV_HEADER_SIZE + resume_frames * self.block_align)
+                self._file.seek(0, os.SEEK_END)
+                self.frames = resume_frames
+                self._update_wav_header()
+        elif self.format == "flac":
+            if resume_frames is not None:
+                raise ValueError("Resuming is only supported for WAV files")
+            self._file = sf.SoundFile(
+                path, mode="w", samplerate=samplerate, channels=channels, subtype="PCM_16"
+            )
+        else:
+            raise ValueError("Unsupported audio format %s" % self.format)
+
+    def _wav_header(self, data_size):
+        return struct.pack(
+            "<4sI4s4sIHHIIHH4sI",
+            b"RIFF",
+            36 + data_size,
+            b"WAVE",
+            b"fmt ",
+            16,
+            1,  # PCM
+            self.channels,
+            self.samplerate,
+            self.samplerate * self.block_align,
+            self.block_align,
+            16,
+            b"data",
+            data_size,
+        )
+
+    def _update_wav_header(self):
+        position = self._file.tell()
+        self._file.seek(0)
+        self._file.write(self._wav_header(self.frames * self.block_align))
+        self._file.seek(position)
+
+    def write(self, waveform):
+        # waveform: float array in [-1, 1], [samples] or [samples, channels]
+        waveform = np.asarray(waveform, dtype=np.float32)
+        if self.format == "wav":
+            pcm = np.clip(np.round(waveform * 32767), -32768, 32767).astype("<i2")
+            self._file.write(pcm.tobytes())
+        else:
+            self._file.write(waveform)
+        self.frames += waveform.shape[0]
+
+    def flush(self):
+        if self.format == "wav":
+            self._update_wav_header()
+        self._file.flush()
+
+    def close(self):
+        if self._file is None:
+            return
+        self.flush()
+        self._file.close()
+        self._file = None
+
+    @property
+    def duration(self):
+        return self.frames / self.samplerate
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -20,6 +20,3 @@ def ensure_checkpoints():
             print(f"✅ Saved to {path}")
         else:
             print(f"✅ Found: {name}")
-
-# Call this in infer.py or the notebook
-ensure_checkpoints()
@@ -0,0 +1,145 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+import torch
+
+
+class PipelineExecutor:
+    """Run post-processing jobs in the background while the main thread keeps sampling.
+
+    Jobs run in submission order on a single worker thread, and on their own
+    CUDA stream when the device is a GPU, so they can depend on each other
+    (e.g. appending to the same file). Every stage, in the foreground or the
+    background, is recorded in a timeline of host timestamps. On a GPU a stage
+    does not wait for its kernels: it records a CUDA event, and the stage's end
+    is moved to the time that event completed when the timeline is read.
+    Background jobs synchronize their own stream before their result is
+    handed out, which only blocks the worker thread.
+
+    With enabled=False jobs run inline, which gives the sequential baseline
+    with the same timeline.
+    """
+
+    def __init__(self, device, enabled=True):
+        self.device = torch.device(device)
+        self.enabled = enabled
+        self.use_stream = enabled and self.device.type == "cuda"
+        self.stream = torch.cuda.Stream(self.device) if self.use_stream else None
+        self.pool = (
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix="postprocess")
+            if enabled
+            else None
+        )
+        self.futures = []
+        self.timeline = []
+        # (timeline record, CUDA event at the end of the stage) not resolved yet
+        self.pending_events = []
+        self.start_time = time.time()
+        self.start_event = None
+        if self.device.type == "cuda":
+            self.start_event = torch.cuda.Event(enable_timing=True)
+            self.start_event.record(torch.cuda.current_stream(self.device))
+
+    @contextmanager
+    def stage(self, name, segment=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            record = {
+                "stage": name,
+                "segment": segment,
+                "thread": threading.current_thread().name,
+                "start": start - self.start_time,
+                "end": time.time() - self.start_time,
+            }
+            if self.start_event is not None:
+                event = torch.cuda.Event(enable_timing=True)
+                event.record(torch.cuda.current_stream(self.device))
+                self.pending_events.append((record, event))
+            self.timeline.append(record)
+
+    def resolve_events(self):
+        # the end of a GPU stage is when its last kernel finished, if that is after the host left it
+        pending, self.pending_events = self.pending_events, []
+        for record, event in pending:
+            event.synchronize()
+            record["end"] = max(record["end"], self.start_event.elapsed_time(event) / 1000)
+
+    def submit(self, name, segment, fn, *args, tensors=()):
+        # tensors: GPU tensors produced on the main stream that fn reads
+        if not self.enabled:
+            future = Future()
+            with self.stage(name, segment):
+                future.set_result(fn(*args))
+            return future
+
+        event = None
+        if self.use_stream:
+            event = torch.cuda.Event()
+            event.record()
+            for tensor in tensors:
+                tensor.record_stream(self.stream)
+
+        def job():
+            if not self.use_stream:
+                with self.stage(name, segment):
+                    return fn(*args)
+            self.stream.wait_event(event)
+            with torch.cuda.stream(self.stream):
+                with self.stage(name, segment):
+                    result = fn(*args)
+            # results (e.g. prefetched embeddings) are read on the main stream
+            self.stream.synchronize()
+            return result
+
+        self.raise_errors()
+        future = self.pool.submit(job)
+        self.futures.append(future)
+        return future
+
+    def raise_errors(self):
+        # surface failures of finished background jobs early
+        pending = []
+        for future in self.futures:
+            if future.done():
+                future.result()
+            else:
+                pending.append(future)
+        self.futures = pending
+
+    def wait(self):
+        for future in self.futures:
+            future.result()
+        self.futures = []
+
+    def close(self):
+        self.wait()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def summary(self):
+        self.resolve_events()
+        stages = OrderedDict()
+        for record in self.timeline:
+            total, count = stages.get(record["stage"], (0.0, 0))
+            stages[record["stage"]] = (total + record["end"] - record["start"], count + 1)
+        wall = max([record["end"] for record in self.timeline], default=0.0)
+        busy = sum(record["end"] - record["start"] for record in self.timeline)
+        return stages, wall, busy
+
+    def print_summary(self):
+        stages, wall, busy = self.summary()
+        print("Pipeline timeline (host time):")
+        for name, (total, count) in stages.items():
+            print(f"  {name:<16} {total:8.2f} s over {count} call(s)")
+        print(f"  sum of stages {busy:.2f} s, wall time {wall:.2f} s, overlapped {max(0.0, busy - wall):.2f} s")
+
+    def save_timeline(self, path):
+        self.resolve_events()
+        with open(path, "w") as f:
+            json.dump(self.timeline, f, indent=1)
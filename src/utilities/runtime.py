@@ -0,0 +1,111 @@
+"""
+Setup shared by the inference entry points (infer_musicldm_continuous.py,
+musicldm_server.py and the conversion and validation scripts). Importing this
+module has no side effects; the entry points call prepare_checkpoints() once
+at startup.
+"""
+
+import os
+
+import numpy as np
+import torch
+from packaging import version
+
+from hifigan import CrossfadeTrack
+from utilities.audio.writer import IncrementalAudioWriter
+from utilities.chkpt import ensure_checkpoints
+
+# Path to your local inference config
+CONFIG_PATH = 'config/musicldm_inference.yaml'
+
+_patched = False
+
+
+def apply_torch_patches():
+    # 🧠 Monkey-patch torch.load to allow loading older .pt/.ckpt files
+    # This is a workaround for the issue where torch.load() does not accept the 'weights_only' argument in older versions of PyTorch.
+    # Allow problematic NumPy globals for legacy checkpoints
+    global _patched
+    if _patched:
+        return
+    _patched = True
+
+    # Only apply monkey-patches if PyTorch >= 2.0
+    if version.parse(torch.__version__) < version.parse("2.0"):
+        print(f"⚠️ PyTorch version {torch.__version__} is below 2.0 — no patching necessary.")
+        return
+    print(f"🛠 Applying patches for PyTorch {torch.__version__}...")
+
+    from torch.serialization import add_safe_globals
+
+    # Patch 1: Allow old NumPy scalar used in checkpoint
+    add_safe_globals([np.core.multiarray.scalar])
+
+    # Patch 2: Monkey-patch torch.load to default to weights_only=False
+    original_load = torch.load
+    def patched_load(*args, **kwargs):
+        if 'weights_only' not in kwargs:
+            kwargs['weights_only'] = False
+        return original_load(*args, **kwargs)
+    torch.load = patched_load
+
+    # Patch 3: Monkey-patch load_state_dict to handle bad CLAP keys
+    original_load_state_dict = torch.nn.Module.load_state_dict
+
+    def safe_load_state_dict(self, state_dict, *args, **kwargs):
+        known_bad_keys = ["text_branch.embeddings.position_ids"]
+        removed_keys = []
+
+        if isinstance(state_dict, dict):
+            for key in known_bad_keys:
+                if key in state_dict:
+                    state_dict.pop(key)
+                    removed_keys.append(key)
+
+        if 'strict' not in kwargs and removed_keys:
+            kwargs['strict'] = False
+
+        if removed_keys:
+            print(f"🐒 Monkey-patch: removed {removed_keys} from checkpoint and set strict={kwargs['strict']}")
+
+        return original_load_state_dict(self, state_dict, *args, **kwargs)
+
+    torch.nn.Module.load_state_dict = safe_load_state_dict
+
+    print("✅ Monkey patches applied successfully.")
+
+
+def prepare_checkpoints():
+    # this will download the checkpoints if they are not already present
+    ensure_checkpoints()
+    apply_torch_patches()
+
+
+def read_prompts(path):
+    return [str(t) for t in np.atleast_1d(np.genfromtxt(path, dtype=str, delimiter="\n"))]
+
+
+def open_combined_track(latent_diffusion, savepath, name, audio_format="wav", resume=None):
+    # same file name save_waveform would use for a single waveform
+    path = os.path.join(savepath, "%s_%s_%s.%s" % (latent_diffusion.global_step, 0, name, audio_format))
+    writer = IncrementalAudioWriter(
+        path, samplerate=16000, resume_frames=None if resume is None else resume["samples_out"]
+    )
+
+    def write(chunk):
+        writer.write(chunk[0])
+        # every segment is listenable as soon as it is written
+        writer.flush()
+
+    # built from the waveforms already vocoded for scoring, crossfaded at the seams
+    stream = CrossfadeTrack(sink=write)
+    if resume is not None:
+        stream.load_state_dict(resume)
+    stream.writer = writer
+    return stream
+
+
+def close_combined_track(stream):
+    stream.flush()
+    stream.writer.close()
+    print(f"Saved {stream.writer.path} ({stream.writer.duration:.1f} s)")
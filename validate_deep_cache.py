@@ -0,0 +1,119 @@
+"""
+Compare DDIM sampling with the deep feature cache against the full UNet on the Treatise prompts.
+
+    python validate_deep_cache.py --intervals 2 3 5 --seeds 0 1 2
+    python validate_deep_cache.py --intervals 3 --depth 4 --texts treatise_commands.txt
+
+Every prompt is generated (first segment, one candidate per prompt) with the
+full UNet on every step and with each refresh interval, from the same seed.
+All runs are scored with CLAP, and the cached runs are compared with the full
+run by log-mel and log-spectrogram L1 error. Sampling time and the number of
+full and cached UNet steps, summed over the seeds, are reported for every run.
+"""
+
+import sys
+sys.path.append("src")
+
+import json
+import argparse
+
+import numpy as np
+import torch
+import yaml
+
+from utilities.runtime import CONFIG_PATH, prepare_checkpoints, read_prompts
+from validate_precision import build_model, clap_scores, generate, log_spectrogram
+
+
+def main(config, prompts, seeds, intervals, depth, device, steps=None, weights=None, output=None):
+    device = torch.device(device)
+    latent_diffusion = build_model(config, device, weights)
+    steps = steps if steps is not None else latent_diffusion.evaluation_params["ddim_sampling_steps"]
+    texts = ["experimental music is playing " + prompt for prompt in prompts]
+
+    runs = {}
+    unet_steps = {}
+    for interval in [None] + intervals:
+        name = "full" if interval is None else "interval_%s" % interval
+        latent_diffusion.set_deep_cache(interval, depth)
+        runs[name] = []
+        for seed in seeds:
+            runs[name].append(generate(latent_diffusion, texts, seed, steps))
+            if interval is not None:
+                # the counters are reset at the start of every run, sum them over the seeds
+                report = latent_diffusion.model.diffusion_model.feature_cache.report()
+                if name not in unet_steps:
+                    unet_steps[name] = report
+                else:
+                    unet_steps[name]["full_unet_steps"] += report["full_unet_steps"]
+                    unet_steps[name]["cached_unet_steps"] += report["cached_unet_steps"]
+        if name in unet_steps and unet_steps[name]["cached_unet_steps"] == 0 and steps > interval:
+            raise RuntimeError("The deep feature cache was never used with interval %s" % interval)
+    latent_diffusion.set_deep_cache(None)
+
+    scores = {
+        name: [clap_scores(latent_diffusion, waveform, texts, seed) for seed, (_, waveform, _) in zip(seeds, run)]
+        for name, run in runs.items()
+    }
+    results = []
+    summary = {"steps": steps, "depth": depth, "runs": {}}
+    for name in runs:
+        for i, seed in enumerate(seeds):
+            mel_ref, waveform_ref, _ = runs["full"][i]
+            mel, waveform, _ = runs[name][i]
+            mel_error = (mel - mel_ref).abs().mean(dim=(1, 2, 3))
+            spectral_error = (log_spectrogram(waveform) - log_spectrogram(waveform_ref)).abs().mean(dim=(1, 2))
+            for j, prompt in enumerate(prompts):
+                results.append(
+                    {
+                        "run": name,
+                        "seed": seed,
+                        "prompt": prompt,
+                        "clap": scores[name][i][j].item(),
+                        "clap_full": scores["full"][i][j].item(),
+                        "log_mel_l1": mel_error[j].item(),
+                        "log_spectrogram_l1": spectral_error[j].item(),
+                    }
+                )
+        run_results = [r for r in results if r["run"] == name]
+        summary["runs"][name] = {
+            "clap": float(np.mean([r["clap"] for r in run_results])),
+            "clap_delta": float(np.mean([r["clap"] - r["clap_full"] for r in run_results])),
+            "log_mel_l1": float(np.mean([r["log_mel_l1"] for r in run_results])),
+            "log_spectrogram_l1": float(np.mean([r["log_spectrogram_l1"] for r in run_results])),
+            "seconds": float(np.mean([stats["seconds"] for _, _, stats in runs[name]])),
+        }
+        if name in unet_steps:
+            summary["runs"][name].update(unet_steps[name])
+
+    full_seconds = summary["runs"]["full"]["seconds"]
+    for name, run in summary["runs"].items():
+        line = f"{name:<12} CLAP {run['clap']:.4f} ({run['clap_delta']:+.4f})  log-mel L1 {run['log_mel_l1']:.4f}"
+        line += f"  log-spec L1 {run['log_spectrogram_l1']:.4f}  {run['seconds']:.1f} s ({full_seconds / run['seconds']:.2f}x)"
+        if "full_unet_steps" in run:
+            line += f"  UNet full/cached steps {run['full_unet_steps']}/{run['cached_unet_steps']}"
+        print(line)
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump({"summary": summary, "results": results}, f, indent=1)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--intervals", type=int, nargs="+", default=[2, 3, 5], help="Refresh intervals to compare with the full UNet")
+    parser.add_argument("--depth", type=int, default=3, help="UNet input and output blocks recomputed on cached steps")
+    parser.add_argument("--texts", type=str, default="treatise_commands.txt", help="File with one prompt per line")
+    parser.add_argument("--max_prompts", type=int, default=None, help="Only use the first prompts of the file")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2])
+    parser.add_argument("--steps", type=int, default=None, help="DDIM steps (defaults to ddim_sampling_steps in the config)")
+    parser.add_argument("--weights", type=str, default=None, help="Inference bundle written by convert_musicldm_checkpoint.py")
+    parser.add_argument("--output", type=str, default=None, help="Write the per-prompt results and the summary to this JSON file")
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    prepare_checkpoints()
+    config = yaml.load(open(CONFIG_PATH, "r"), Loader=yaml.FullLoader)
+    prompts = read_prompts(args.texts)[: args.max_prompts]
+    main(config, prompts, args.seeds, args.intervals, args.depth, args.device, steps=args.steps, weights=args.weights, output=args.output)
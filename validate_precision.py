@@ -0,0 +1,175 @@
+"""
+Compare a mixed-precision policy against fp32 on a fixed set of prompts and seeds.
+
+    python validate_precision.py --precision bf16 --texts treatise_commands.txt --seeds 0 1 2
+    python validate_precision.py --precision unet=bf16,vae=bf16,vocoder=fp32,clap=fp16
+
+Every prompt is generated (first segment, one candidate per prompt) with fp32
+and with the policy, from the same seed. Both are scored with CLAP in fp32,
+and the policy's audio is compared with the fp32 audio by log-mel and
+log-spectrogram L1 error. Sampling time and peak GPU memory are reported for
+both precisions.
+"""
+
+import sys
+sys.path.append("src")
+
+import json
+import time
+import argparse
+
+import numpy as np
+import torch
+import yaml
+from pytorch_lightning import seed_everything
+
+from src.latent_diffusion.models.musicldm import MusicLDM
+from latent_diffusion.models.inference import build_inference_model
+from latent_diffusion.modules.precision import PrecisionPolicy
+from utilities.runtime import CONFIG_PATH, prepare_checkpoints, read_prompts
+
+
+def log_spectrogram(waveform, n_fft=1024, hop_length=256):
+    # waveform: [bs, 1, t-samples] -> [bs, n_fft // 2 + 1, frames]
+    spec = torch.stft(
+        waveform.reshape(waveform.size(0), -1),
+        n_fft=n_fft,
+        hop_length=hop_length,
+        window=torch.hann_window(n_fft),
+        return_complex=True,
+    ).abs()
+    return torch.log(spec.clamp(min=1e-5))
+
+
+def generate(latent_diffusion, texts, seed, steps):
+    # one candidate per prompt, the noise only depends on the seed
+    device = latent_diffusion.device
+    params = latent_diffusion.evaluation_params
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.time()
+
+    seed_everything(seed)
+    with latent_diffusion.ema_scope():
+        c = latent_diffusion.get_learned_conditioning(texts)
+        unconditional_conditioning = None
+        if params["unconditional_guidance_scale"] != 1.0:
+            unconditional_conditioning = latent_diffusion.cond_stage_model.get_unconditional_condition(len(texts))
+        samples, _ = latent_diffusion.sample_log(
+            cond=c,
+            batch_size=len(texts),
+            x_T=None,
+            ddim=True,
+            ddim_steps=steps,
+            eta=1.0,
+            unconditional_guidance_scale=params["unconditional_guidance_scale"],
+            unconditional_conditioning=unconditional_conditioning,
+        )
+        mel = latent_diffusion.decode_first_stage(samples)
+        waveform = latent_diffusion.mel_spectrogram_to_waveform(mel, save=False)
+
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    stats = {
+        "seconds": time.time() - start,
+        "peak_memory_gb": torch.cuda.max_memory_allocated(device) / 1024**3 if device.type == "cuda" else None,
+    }
+    return mel.float().cpu(), torch.from_numpy(waveform).float(), stats
+
+
+def clap_scores(latent_diffusion, waveform, texts, seed):
+    # the same seed gives both precisions the same random crop
+    seed_everything(seed)
+    return latent_diffusion.cond_stage_model.cos_similarity(waveform.squeeze(1), texts).view(-1).cpu()
+
+
+def build_model(config, device, weights=None):
+    if weights is None:
+        latent_diffusion = MusicLDM(**config["model"]["params"])
+        latent_diffusion.bake_ema()
+        latent_diffusion.to(device)
+    else:
+        latent_diffusion = build_inference_model(config, weights, device)
+    latent_diffusion.eval()
+    latent_diffusion.cond_stage_key = "text"
+    latent_diffusion.cond_stage_model.embed_mode = "text"
+    # scores must not depend on the random unconditional replacement of the conditioner
+    latent_diffusion.cond_stage_model.unconditional_prob = 0.0
+    return latent_diffusion
+
+
+def main(config, prompts, seeds, precision, device, steps=None, weights=None, output=None):
+    device = torch.device(device)
+    latent_diffusion = build_model(config, device, weights)
+    steps = steps if steps is not None else latent_diffusion.evaluation_params["ddim_sampling_steps"]
+    texts = ["experimental music is playing " + prompt for prompt in prompts]
+
+    policy = PrecisionPolicy.parse(precision)
+    fp32 = PrecisionPolicy()
+    runs = {}
+    for name, run_policy in [("fp32", fp32), ("policy", policy)]:
+        latent_diffusion.set_precision_policy(run_policy)
+        runs[name] = [generate(latent_diffusion, texts, seed, steps) for seed in seeds]
+
+    latent_diffusion.set_precision_policy(fp32)
+    results = []
+    for i, seed in enumerate(seeds):
+        mel_ref, waveform_ref, stats_ref = runs["fp32"][i]
+        mel, waveform, stats = runs["policy"][i]
+        score_ref = clap_scores(latent_diffusion, waveform_ref, texts, seed)
+        score = clap_scores(latent_diffusion, waveform, texts, seed)
+        mel_error = (mel - mel_ref).abs().mean(dim=(1, 2, 3))
+        spectral_error = (log_spectrogram(waveform) - log_spectrogram(waveform_ref)).abs().mean(dim=(1, 2))
+        for j, prompt in enumerate(prompts):
+            results.append(
+                {
+                    "seed": seed,
+                    "prompt": prompt,
+                    "clap_fp32": score_ref[j].item(),
+                    "clap_policy": score[j].item(),
+                    "log_mel_l1": mel_error[j].item(),
+                    "log_spectrogram_l1": spectral_error[j].item(),
+                }
+            )
+            print(
+                f"seed {seed} {prompt[:40]:<40} CLAP fp32 {score_ref[j]:.4f} {policy} {score[j]:.4f}"
+                f"  log-mel L1 {mel_error[j]:.4f}  log-spec L1 {spectral_error[j]:.4f}"
+            )
+
+    summary = {
+        "precision": str(policy),
+        "steps": steps,
+        "clap_fp32": float(np.mean([r["clap_fp32"] for r in results])),
+        "clap_policy": float(np.mean([r["clap_policy"] for r in results])),
+        "log_mel_l1": float(np.mean([r["log_mel_l1"] for r in results])),
+        "log_spectrogram_l1": float(np.mean([r["log_spectrogram_l1"] for r in results])),
+    }
+    for name in runs:
+        summary[name + "_seconds"] = float(np.mean([stats["seconds"] for _, _, stats in runs[name]]))
+        if device.type == "cuda":
+            summary[name + "_peak_memory_gb"] = max(stats["peak_memory_gb"] for _, _, stats in runs[name])
+    print("Summary:", summary)
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump({"summary": summary, "results": results}, f, indent=1)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--precision", type=str, default="bf16", help="Policy to validate, e.g. bf16 or unet=bf16,vae=bf16,vocoder=fp32,clap=fp16")
+    parser.add_argument("--texts", type=str, default="treatise_commands.txt", help="File with one prompt per line")
+    parser.add_argument("--max_prompts", type=int, default=4, help="Only use the first prompts of the file")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2])
+    parser.add_argument("--steps", type=int, default=None, help="DDIM steps (defaults to ddim_sampling_steps in the config)")
+    parser.add_argument("--weights", type=str, default=None, help="Inference bundle written by convert_musicldm_checkpoint.py")
+    parser.add_argument("--output", type=str, default=None, help="Write the per-prompt results and the summary to this JSON file")
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    prepare_checkpoints()
+    config = yaml.load(open(CONFIG_PATH, "r"), Loader=yaml.FullLoader)
+    prompts = read_prompts(args.texts)[: args.max_prompts]
+    main(config, prompts, args.seeds, args.precision, args.device, steps=args.steps, weights=args.weights, output=args.output)